@@ -1,10 +1,42 @@
-from notification.utils import maybe_delay
+from notification.conf import settings
+from notification.utils import can_queue
+
+
+def can_receive(user, medium):
+    """
+    Returns whether ``user`` can be reached through ``medium`` at all,
+    regardless of their notice settings, as told by the backend of
+    ``medium``.
+    """
+    from notification.backends import get_backend_class
+    backend_class = get_backend_class(medium)
+    if backend_class is None:
+        # mediums without backend, i.e. digests, are sent by email
+        return bool(user.is_active and user.email)
+    return backend_class.can_receive(user)
 
 
 def can_send(user, notice_type, medium):
     from notification.models import NoticeSetting
-    should_send = NoticeSetting.objects.get_for(user, notice_type, medium).send
-    return should_send and user.email and user.is_active
+    # check the user first, it doesn't need any query
+    if not can_receive(user, medium):
+        return False
+    return NoticeSetting.objects.should_send(user, notice_type, medium)
+
+
+def filter_can_send(users, notice_type, medium):
+    """
+    Returns the list of ``users`` that can be sent notices of ``notice_type``
+    through ``medium``. Settings are resolved with a single query, only for
+    the users that can receive anything through ``medium``, and missing ones
+    fall back to their default without being saved.
+    """
+    from notification.models import NoticeSetting
+    users = [user for user in users if can_receive(user, medium)]
+    if not users:
+        return []
+    send_map = NoticeSetting.objects.send_map(users, notice_type, medium)
+    return [user for user in users if send_map[user.pk]]
 
 
 def send(*args, **kwargs):
@@ -13,6 +45,15 @@ def send(*args, **kwargs):
     flag NOTIFICATION_USE_QUEUE that helps determine whether all calls should
     be queued or not. A per call ``use_queue`` keyword argument can be
     used to always override the default global behavior.
+
+    Queued calls pass users, sender and the model instances of the extra
+    context by reference. When NOTIFICATION_QUEUE_CHUNK_SIZE is set, the
+    users are split into chunks each sent by its own task.
     """
-    from notification.tasks import notify
-    maybe_delay(notify, *args, **kwargs)
+    from notification.tasks import notify, notify_in_chunks, delay_notify
+    use_queue = kwargs.pop('use_queue', settings.NOTIFICATION_USE_QUEUE)
+    if not can_queue(notify, use_queue=use_queue):
+        return notify(*args, **kwargs)
+    if settings.NOTIFICATION_QUEUE_CHUNK_SIZE:
+        return notify_in_chunks(*args, **kwargs)
+    return delay_notify(*args, **kwargs)
@@ -30,12 +30,8 @@
 
 import urlparse
 from xml.sax.saxutils import XMLGenerator
-from datetime import datetime
 
-try:
-    from django.utils.timezone import now
-except ImportError:
-    now = datetime.now
+from django.utils.timezone import now
 
 GENERATOR_TEXT = 'django-atompub'
 GENERATOR_ATTR = {
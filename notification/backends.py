@@ -0,0 +1,156 @@
+"""
+Delivery backends of the notification media.
+
+NOTIFICATION_BACKENDS maps the mediums of NOTIFICATION_MEDIA to the dotted
+path of their backend class. ``notify`` instantiates each backend once per
+call and hands it the notices to deliver one batch at a time, so backends
+can use the bulk APIs of their providers. Mediums without a backend, such
+as the digest medium, are not delivered by ``notify``.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from notification.conf import settings
+from notification.utils import context_language, send_email_messages
+
+
+class BaseBackend(object):
+    """
+    Base class of the delivery backends.
+
+    Backends are instantiated with the medium they deliver and the
+    ``extra_context``, ``from_email`` and ``headers`` of the notify call.
+    Other keyword arguments are ignored, so that options of a given backend,
+    such as the ``connection`` of the email backend, can be passed to all.
+
+    Backends implement ``deliver_batch``, and ``render_batch`` if they have
+    anything to render, or override ``send_batch`` altogether. Those setting
+    ``supports_concurrency`` are delivered by several threads at once by
+    ``notification.engine.DeliveryEngine``, each with its own instance.
+    """
+
+    supports_concurrency = False
+
+    def __init__(self, medium, extra_context=None, from_email=None,
+                 headers=None, **kwargs):
+        self.medium = medium
+        self.extra_context = extra_context
+        self.from_email = from_email
+        self.headers = headers
+
+    @classmethod
+    def can_receive(cls, user):
+        """
+        Returns whether ``user`` can be reached through the backend at all,
+        regardless of their notice settings.
+        """
+        return user.is_active
+
+    def send_batch(self, notices):
+        """
+        Delivers ``notices``, whose recipients' settings have already been
+        checked, and returns the number of notices delivered. The notices
+        are saved, so their primary keys and URLs can be relied on.
+        """
+        return self.deliver_batch(self.render_batch(notices))
+
+    def render_batch(self, notices):
+        """
+        Returns the list of messages to deliver for ``notices``. Only this
+        step touches the database and the templates.
+        """
+        return list(notices)
+
+    def deliver_batch(self, messages):
+        """
+        Delivers the rendered ``messages`` and returns how many were.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the resources held by the backend, e.g. connections.
+        """
+        pass
+
+
+class EmailBackend(BaseBackend):
+    """
+    Sends each notice as an email, all over ``connection`` or else over one
+    connection opened on the first batch.
+    """
+
+    supports_concurrency = True
+
+    def __init__(self, medium, connection=None, **kwargs):
+        super(EmailBackend, self).__init__(medium, **kwargs)
+        self.connection = connection
+        # only close the connections we opened
+        self.opened = False
+
+    @classmethod
+    def can_receive(cls, user):
+        return bool(user.is_active and user.email)
+
+    def render_batch(self, notices):
+        messages = []
+        for notice in notices:
+            with context_language(notice.recipient):
+                messages.append(notice.get_email_message(
+                    self.extra_context, self.from_email, self.headers))
+        return messages
+
+    def deliver_batch(self, messages):
+        if not messages:
+            return 0
+        if self.connection is None:
+            from django.core.mail import get_connection
+            self.connection = get_connection()
+            self.connection.open()
+            self.opened = True
+        return send_email_messages(messages, self.connection)
+
+    def close(self):
+        if self.opened:
+            self.connection.close()
+            self.connection = None
+            self.opened = False
+
+
+# dotted path -> backend class
+_backend_classes = {}
+
+
+def get_backend_class(medium):
+    """
+    Returns the backend class of ``medium``, or None if it has none.
+    """
+    path = settings.NOTIFICATION_BACKENDS.get(medium)
+    if path is None:
+        return None
+    try:
+        return _backend_classes[path]
+    except KeyError:
+        pass
+    module_name, _, class_name = path.rpartition(".")
+    try:
+        backend_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise ImproperlyConfigured("Error loading notification backend %r "
+                                   "for medium %r: %s" % (path, medium, e))
+    _backend_classes[path] = backend_class
+    return backend_class
+
+
+def get_backends(**kwargs):
+    """
+    Returns a list of (medium, backend) pairs, one per medium of
+    NOTIFICATION_MEDIA having a backend, in the order of NOTIFICATION_MEDIA.
+    ``kwargs`` are passed to the backends.
+    """
+    backends = []
+    for medium, display in settings.NOTIFICATION_MEDIA:
+        backend_class = get_backend_class(medium)
+        if backend_class is not None:
+            backends.append((medium, backend_class(medium, **kwargs)))
+    return backends
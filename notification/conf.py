@@ -14,8 +14,72 @@ class NotificationConf(AppConf):
         "1": 2,  # email
     }
 
+    # maps mediums to the dotted path of their delivery backend; see
+    # notification.backends
+    BACKENDS = {
+        "1": "notification.backends.EmailBackend",
+    }
+
+    # maps mediums to how many threads deliver their notices at once in
+    # notify; see notification.engine
+    CONCURRENCY = {}
+
+    # medium whose notices are held back and emailed by send_digests, e.g.
+    # "2" after adding ("2", _("Email digest")) to NOTIFICATION_MEDIA
+    DIGEST_MEDIUM = None
+
     LANGUAGE_MODULE = False
 
     USE_QUEUE = False
 
+    # split queued sends into tasks of this many users
+    QUEUE_CHUNK_SIZE = None
+
     USE_PYNLINER = False
+
+    # how many CSS inlined email bodies are kept in memory
+    PYNLINER_CACHE_SIZE = 128
+
+    # only store notice settings that differ from their default
+    SPARSE_SETTINGS = False
+
+    # share cached lookups (e.g. notice types) through Django's cache
+    USE_CACHE = False
+
+    CACHE_TIMEOUT = 60 * 60
+
+    # seconds before process-local caches of shared data (e.g. notice types)
+    # are reloaded when NOTIFICATION_USE_CACHE is off
+    LOCAL_CACHE_TIMEOUT = 60
+
+    # how many compiled notice templates are kept in memory
+    TEMPLATE_CACHE_SIZE = 256
+
+    # maps notice type labels to (days before archiving notices, days before
+    # deleting archived notices), None meaning never; see purge_notices
+    RETENTION = {}
+
+    DEFAULT_RETENTION = (None, None)
+
+    # let SeenNoticesMiddleware batch the updates of Notice.is_unseen
+    DEFER_SEEN = True
+
+    # maps mediums, or (medium, notice type label) pairs, to (number, seconds)
+    # delivery limits per user; see notification.ratelimit
+    RATE_LIMITS = {}
+
+    # "drop", "digest" or "on_site"
+    RATE_LIMIT_OVERFLOW = "on_site"
+
+    # seconds during which notices sharing a group key are coalesced; needs
+    # a cache shared by all processes, e.g. memcached
+    COALESCE_WINDOW = None
+
+    # how many notices are listed per page
+    PAGE_SIZE = 20
+
+    # caps the latest_notices context variable
+    LATEST_NOTICES_LIMIT = None
+
+    # how many notices are rendered and written at once by notify
+    BATCH_SIZE = 500
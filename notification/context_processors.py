@@ -1,11 +1,93 @@
+from notification.conf import settings
 from notification.models import Notice
 
 
 def notification(request):
+    """
+    Adds ``notice_unseen_count`` and ``latest_notices`` to the context of
+    authenticated users.
+
+    Both are lazy: the database is only queried when a template uses them
+    and the results are kept for the rest of the request. The number of
+    ``latest_notices`` is capped by NOTIFICATION_LATEST_NOTICES_LIMIT.
+    """
     if request.user.is_authenticated():
-        return {
-            'notice_unseen_count': Notice.objects.unseen_count_for(request.user, on_site=True),
-            'latest_notices': Notice.objects.get_for(request.user, on_site=True)
-        }
+        if not hasattr(request, "_notification_context"):
+            request._notification_context = get_notification_context(request.user)
+        return dict(request._notification_context)
     else:
         return {}
+
+
+class LazyCount(object):
+    """
+    An integer computed by ``func`` on first use, which prints, converts and
+    compares like one.
+    """
+
+    def __init__(self, func):
+        self._func = func
+
+    @property
+    def value(self):
+        if not hasattr(self, "_value"):
+            self._value = self._func()
+        return self._value
+
+    def __int__(self):
+        return self.value
+
+    __index__ = __int__
+
+    def __str__(self):
+        return str(self.value)
+
+    def __unicode__(self):
+        return unicode(self.value)  # noqa
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    __bool__ = __nonzero__
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def _other(self, other):
+        if isinstance(other, LazyCount):
+            return other.value
+        return other
+
+    def __eq__(self, other):
+        return self.value == self._other(other)
+
+    def __ne__(self, other):
+        return self.value != self._other(other)
+
+    def __lt__(self, other):
+        return self.value < self._other(other)
+
+    def __le__(self, other):
+        return self.value <= self._other(other)
+
+    def __gt__(self, other):
+        return self.value > self._other(other)
+
+    def __ge__(self, other):
+        return self.value >= self._other(other)
+
+
+def get_notification_context(user):
+    # querysets are lazy and cache their results already
+    latest_notices = Notice.objects.get_for(user, on_site=True).select_related(
+        "sender", "notice_type")
+    if settings.NOTIFICATION_LATEST_NOTICES_LIMIT:
+        latest_notices = latest_notices[:settings.NOTIFICATION_LATEST_NOTICES_LIMIT]
+
+    return {
+        'notice_unseen_count': LazyCount(lambda: Notice.objects.unseen_count(user)),
+        'latest_notices': latest_notices,
+    }
@@ -0,0 +1,121 @@
+"""
+Concurrent delivery of notices.
+
+Delivering is mostly waiting on the network, so NOTIFICATION_CONCURRENCY
+lets a few threads per medium deliver at once while the calling thread
+keeps rendering, which stays sequential.
+"""
+import math
+import logging
+import threading
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+from notification.backends import get_backends, get_backend_class
+from notification.conf import settings
+from notification.utils import chunked
+
+logger = logging.getLogger('notification')
+
+
+class DeliveryEngine(object):
+    """
+    Hands batches of notices to the backend of their medium.
+
+    The batches of a medium with a ``concurrency`` above 1 whose backend
+    supports it are rendered in the calling thread, split, and delivered by
+    that many worker threads, each with its own backend instance (e.g. its
+    own SMTP connection). ``send`` blocks while all the workers of the
+    medium are busy. Other mediums are delivered in the calling thread.
+
+    ``concurrency`` maps mediums to numbers of threads and defaults to
+    NOTIFICATION_CONCURRENCY; ``kwargs`` are passed to the backends.
+
+    ``close`` waits for the deliveries to end and raises the first error of
+    the workers, after which they skip their remaining batches.
+    """
+
+    def __init__(self, concurrency=None, **kwargs):
+        if concurrency is None:
+            concurrency = settings.NOTIFICATION_CONCURRENCY
+        self.concurrency = concurrency
+        self.kwargs = kwargs
+        # (medium, backend) pairs in the order of NOTIFICATION_MEDIA
+        self.backends = get_backends(**kwargs)
+        # medium -> queue of the rendered batches of its workers
+        self.queues = {}
+        self.workers = []
+        self.errors = []
+
+    def send(self, medium, notices):
+        """
+        Delivers ``notices`` through the backend of ``medium``.
+        """
+        backend = dict(self.backends)[medium]
+        threads = self.concurrency.get(medium, 1)
+        if threads <= 1 or not backend.supports_concurrency:
+            backend.send_batch(notices)
+            return
+        if self.errors:
+            # don't render what won't be delivered
+            return
+        messages = backend.render_batch(notices)
+        if not messages:
+            return
+        queue = self.queues.get(medium)
+        if queue is None:
+            queue = self.queues[medium] = Queue(maxsize=threads)
+            for i in range(threads):
+                worker = threading.Thread(target=self._work,
+                                          args=(medium, queue))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        size = int(math.ceil(len(messages) / float(threads)))
+        for part in chunked(messages, size):
+            queue.put(part)
+
+    def _work(self, medium, queue):
+        backend = None
+        try:
+            backend = get_backend_class(medium)(medium, **self.kwargs)
+        except Exception as e:
+            logger.exception("Creating the backend of medium %s failed", medium)
+            self.errors.append(e)
+        try:
+            # keeps draining the queue after errors so that send and close
+            # never block on it
+            while True:
+                messages = queue.get()
+                if messages is None:
+                    break
+                if self.errors:
+                    continue
+                try:
+                    backend.deliver_batch(messages)
+                except Exception as e:
+                    logger.exception("Delivery through medium %s failed", medium)
+                    self.errors.append(e)
+        finally:
+            if backend is not None:
+                backend.close()
+
+    def close(self):
+        """
+        Waits for the deliveries to end and closes the backends.
+        """
+        try:
+            for medium, queue in self.queues.items():
+                for i in range(self.concurrency[medium]):
+                    queue.put(None)
+            for worker in self.workers:
+                worker.join()
+        finally:
+            for medium, backend in self.backends:
+                backend.close()
+            self.queues = {}
+            self.workers = []
+        if self.errors:
+            raise self.errors[0]
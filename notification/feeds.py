@@ -3,6 +3,7 @@ import datetime
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.http import Http404
 from django.template.defaultfilters import linebreaks, escape, striptags
 from django.utils.translation import ugettext_lazy as _
 
@@ -47,7 +48,15 @@ class BaseNoticeFeed(Feed):
 class NoticeUserFeed(BaseNoticeFeed):
 
     def get_object(self, params):
-        return get_object_or_404(User, username=params[0].lower())
+        user = get_object_or_404(User, username=params[0].lower())
+        # an optional second parameter is the cursor of the page
+        cursor = params[1] if len(params) > 1 else None
+        try:
+            self.notices, self.next_cursor = Notice.objects.page_after(
+                user, cursor, ITEMS_PER_FEED)
+        except ValueError:
+            raise Http404
+        return user
 
     def feed_id(self, user):
         return "%s://%s%s" % (
@@ -74,7 +83,18 @@ class NoticeUserFeed(BaseNoticeFeed):
             Site.objects.get_current().domain,
             reverse("notification_notices"),
         )
-        return ({"href": complete_url},)
+        links = [{"href": complete_url}]
+        if self.next_cursor:
+            links.append({
+                "rel": "next",
+                "href": "%s://%s%s?after=%s" % (
+                    DEFAULT_HTTP_PROTOCOL,
+                    Site.objects.get_current().domain,
+                    reverse("notification_feed_for_user"),
+                    self.next_cursor,
+                ),
+            })
+        return links
 
     def items(self, user):
-        return Notice.objects.get_for(user).order_by("-added")[:ITEMS_PER_FEED]
+        return self.notices
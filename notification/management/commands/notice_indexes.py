@@ -0,0 +1,131 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils.timezone import now
+from django.contrib.auth.models import User
+
+from notification.conf import settings
+from notification.feeds import ITEMS_PER_FEED
+from notification.models import Notice, NOTICE_INDEXES
+from notification.utils import encode_cursor
+
+
+class Command(NoArgsCommand):
+    help = ("Runs EXPLAIN on the standard notice queries and reports the ones "
+            "scanning the whole notice table, or paging without using the "
+            "cursor as an index bound.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--database", dest="database", default=DEFAULT_DB_ALIAS,
+            help="Nominates a database to run the queries against."),
+        make_option("--user", dest="user", default=None,
+            help="Username the queries are made for, the first user by default."),
+        make_option("--sql", action="store_true", dest="sql", default=False,
+            help="Prints the CREATE INDEX statements of the recommended indexes."),
+    )
+
+    def handle_noargs(self, **options):
+        database = options["database"]
+        connection = connections[database]
+        table = Notice._meta.db_table
+
+        if options["sql"]:
+            self.print_indexes(connection, table)
+            return
+
+        users = User.objects.using(database).order_by("pk")
+        if options["user"]:
+            users = users.filter(username=options["user"])
+        try:
+            user = users[0]
+        except IndexError:
+            raise CommandError("No user to run the queries for.")
+
+        manager = Notice.objects.db_manager(database)
+        # any notice makes a cursor for the plan of the following pages
+        cursor = encode_cursor(Notice(pk=1, added=now()))
+        # names of the queries paging after a cursor
+        paged = set(["notice list next page", "feed next page"])
+        queries = [
+            ("notice list", manager.page_queryset(user, on_site=True)
+                [:settings.NOTIFICATION_PAGE_SIZE + 1]),
+            ("notice list next page", manager.page_queryset(user, cursor,
+                on_site=True)[:settings.NOTIFICATION_PAGE_SIZE + 1]),
+            ("unseen count", manager.notices_for(user, unseen=True, on_site=True)),
+            ("latest notices", manager.get_for(user, on_site=True)[:10]),
+            ("sent notices", manager.sent(user)),
+            ("feed", manager.page_queryset(user)[:ITEMS_PER_FEED + 1]),
+            ("feed next page", manager.page_queryset(user, cursor)
+                [:ITEMS_PER_FEED + 1]),
+        ]
+
+        scans = 0
+        for name, queryset in queries:
+            sql, params = queryset.query.get_compiler(database).as_sql()
+            columns, plan = self.explain(connection, sql, params)
+            if self.is_table_scan(connection, table, columns, plan):
+                scans += 1
+                self.stdout.write("%s: SEQUENTIAL SCAN\n" % name)
+            elif name in paged and not self.is_bounded(connection, table,
+                                                       columns, plan):
+                scans += 1
+                self.stdout.write("%s: CURSOR NOT USED BY THE INDEX\n" % name)
+            else:
+                self.stdout.write("%s: ok\n" % name)
+            if int(options.get("verbosity", 1)) > 1:
+                for row in plan:
+                    self.stdout.write("    %s\n" % " ".join(unicode(col) for col in row))
+
+        if scans:
+            self.stdout.write("\n%d queries scan %s, run with --sql for the "
+                              "recommended indexes.\n" % (scans, table))
+
+    def explain(self, connection, sql, params):
+        if connection.vendor == "sqlite":
+            sql = "EXPLAIN QUERY PLAN %s" % sql
+        else:
+            sql = "EXPLAIN %s" % sql
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+
+    def is_table_scan(self, connection, table, columns, plan):
+        if connection.vendor == "postgresql":
+            return any(("Seq Scan on %s" % table) in row[0] for row in plan)
+        elif connection.vendor == "mysql":
+            # the columns differ between versions, e.g. partitions
+            table_index, type_index = columns.index("table"), columns.index("type")
+            return any(row[table_index] == table and row[type_index] == "ALL"
+                       for row in plan)
+        elif connection.vendor == "sqlite":
+            return any(unicode(row[-1]).startswith("SCAN") and table in row[-1]
+                       and "INDEX" not in row[-1] for row in plan)
+        raise CommandError("EXPLAIN is not supported for %s." % connection.vendor)
+
+    def is_bounded(self, connection, table, columns, plan):
+        """
+        Returns whether the date of the cursor bounds the index range read,
+        rather than filtering the rows read from the newest on.
+        """
+        added = Notice._meta.get_field("added").column
+        if connection.vendor == "postgresql":
+            return any("Index Cond" in row[0] and added in row[0] for row in plan)
+        elif connection.vendor == "mysql":
+            table_index, type_index = columns.index("table"), columns.index("type")
+            return any(row[table_index] == table and row[type_index] == "range"
+                       for row in plan)
+        elif connection.vendor == "sqlite":
+            # e.g. SEARCH TABLE notice USING INDEX ... (recipient_id=? AND added<?)
+            return any("INDEX" in unicode(row[-1]) and
+                       ("%s<" % added) in unicode(row[-1]) for row in plan)
+        raise CommandError("EXPLAIN is not supported for %s." % connection.vendor)
+
+    def print_indexes(self, connection, table):
+        qn = connection.ops.quote_name
+        for fields in NOTICE_INDEXES:
+            columns = [Notice._meta.get_field(name).column for name in fields]
+            name = "%s_%s" % (table, "_".join(fields))
+            self.stdout.write("CREATE INDEX %s ON %s (%s);\n" % (
+                qn(name[:connection.ops.max_name_length() or 64]), qn(table),
+                ", ".join(qn(column) for column in columns)))
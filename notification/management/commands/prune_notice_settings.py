@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification.conf import settings
+from notification.models import NoticeSetting
+
+
+class Command(NoArgsCommand):
+    help = "Deletes stored notice settings that equal their default."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Number of settings deleted per query."),
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+            help="Only count the settings that would be deleted."),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options["batch_size"]
+        verbosity = int(options.get("verbosity", 1))
+        queryset = NoticeSetting.objects.defaults()
+
+        if options["dry_run"]:
+            self.stdout.write("%d notice settings would be deleted.\n" % queryset.count())
+            return
+
+        if not settings.NOTIFICATION_SPARSE_SETTINGS:
+            self.stderr.write("Warning: NOTIFICATION_SPARSE_SETTINGS is off, "
+                              "pruned settings will be stored again when read.\n")
+
+        deleted = 0
+        last = 0
+        while True:
+            # walks the table once in primary key order instead of scanning
+            # the rows kept by the previous batches again
+            ids = list(queryset.filter(pk__gt=last).order_by("pk").values_list(
+                "pk", flat=True)[:batch_size])
+            if not ids:
+                break
+            last = ids[-1]
+            NoticeSetting.objects.filter(pk__in=ids).delete()
+            deleted += len(ids)
+            if verbosity > 1:
+                self.stdout.write("Deleted %d notice settings so far.\n" % deleted)
+
+        self.stdout.write("Deleted %d notice settings.\n" % deleted)
@@ -0,0 +1,109 @@
+import time
+import datetime
+import operator
+from functools import reduce
+from optparse import make_option
+
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q, Max
+from django.utils.timezone import now
+
+from notification.conf import settings
+from notification.models import Notice, NoticeType
+
+PROGRESS_CACHE_KEY = "notification:purge_notices:%s"
+PROGRESS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# seconds between two progress reports at verbosity 1
+PROGRESS_REPORT_INTERVAL = 10
+
+
+class Command(NoArgsCommand):
+    help = ("Archives and deletes old notices following the "
+            "NOTIFICATION_RETENTION policies.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Width of the primary key range processed per query."),
+        make_option("--sleep", type="float", dest="sleep", default=0.1,
+            help="Seconds to wait between two batches, 0 to not throttle."),
+        make_option("--from-pk", type="int", dest="from_pk", default=None,
+            help="Primary key to start from instead of resuming the last run."),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get("verbosity", 1))
+        started = now()
+        archive_queries = []
+        delete_queries = []
+        for notice_type in NoticeType.objects.all():
+            archive_days, delete_days = settings.NOTIFICATION_RETENTION.get(
+                notice_type.label, settings.NOTIFICATION_DEFAULT_RETENTION)
+            if archive_days is not None:
+                archive_queries.append(Q(notice_type=notice_type,
+                    added__lt=started - datetime.timedelta(days=archive_days)))
+            if delete_days is not None:
+                delete_queries.append(Q(notice_type=notice_type,
+                    added__lt=started - datetime.timedelta(days=delete_days)))
+
+        if archive_queries:
+            self.process("archive", reduce(operator.or_, archive_queries), **options)
+        if delete_queries:
+            self.process("delete", reduce(operator.or_, delete_queries), **options)
+
+    def process(self, action, query, batch_size, sleep, from_pk, **options):
+        """
+        Runs ``action`` on the notices matching ``query``, one primary key
+        range at a time, saving the progress so that an interrupted run is
+        resumed by the next one if the cache is shared. The primary key to
+        resume from is printed on interruption too.
+        """
+        key = PROGRESS_CACHE_KEY % action
+        low = from_pk if from_pk is not None else cache.get(key, 0)
+        max_pk = Notice.objects.aggregate(Max("pk"))["pk__max"] or 0
+
+        processed = 0
+        started = reported = time.time()
+        try:
+            while low <= max_pk:
+                high = low + batch_size
+                queryset = Notice.objects.filter(query, pk__gte=low, pk__lt=high)
+                if action == "archive":
+                    count = self.archive(queryset.filter(archived=False))
+                else:
+                    count = self.delete(queryset.filter(archived=True))
+                processed += count
+                cache.set(key, high, PROGRESS_CACHE_TIMEOUT)
+                if self.verbosity > 1 or (self.verbosity > 0 and
+                        time.time() - reported >= PROGRESS_REPORT_INTERVAL):
+                    reported = time.time()
+                    self.stdout.write("%s: %d notices up to pk %d (%.1f rows/s)\n" % (
+                        action, processed, high, self.rate(processed, started)))
+                low = high
+                if sleep:
+                    time.sleep(sleep)
+        except (KeyboardInterrupt, Exception):
+            # the cache may not outlive this process, e.g. LocMemCache
+            self.stderr.write("%s interrupted after %d notices, resume with "
+                              "--from-pk %d\n" % (action, processed, low))
+            raise
+        cache.delete(key)
+
+        self.stdout.write("%s: %d notices in %.1fs (%.1f rows/s)\n" % (
+            action, processed, time.time() - started, self.rate(processed, started)))
+
+    def rate(self, processed, started):
+        elapsed = time.time() - started
+        return processed / elapsed if elapsed else processed
+
+    def archive(self, queryset):
+        if settings.NOTIFICATION_USE_CACHE:
+            Notice.objects.clear_unseen_count(
+                set(queryset.values_list("recipient", flat=True)))
+        return queryset.update(archived=True)
+
+    def delete(self, queryset):
+        pks = list(queryset.values_list("pk", flat=True))
+        if pks:
+            Notice.objects.filter(pk__in=pks).delete()
+        return len(pks)
@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import Count
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from notification.conf import settings
+from notification.models import Notice, UNSEEN_COUNT_CACHE_KEY
+from notification.utils import chunked
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the cached unseen notice counters from the notices."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Number of users whose counters are rebuilt per query."),
+    )
+
+    def handle_noargs(self, **options):
+        if not settings.NOTIFICATION_USE_CACHE:
+            self.stdout.write("NOTIFICATION_USE_CACHE is off, there are no "
+                              "counters to rebuild.\n")
+            return
+
+        user_ids = User.objects.order_by("pk").values_list("pk", flat=True).iterator()
+        rebuilt = 0
+        for chunk in chunked(user_ids, options["batch_size"]):
+            counts = dict.fromkeys(chunk, 0)
+            counts.update(Notice.objects.filter(
+                recipient__in=chunk,
+                unseen=True,
+                on_site=True,
+                archived=False
+            ).order_by().values_list("recipient").annotate(Count("pk")))
+            cache.set_many(dict((UNSEEN_COUNT_CACHE_KEY % user_id, count)
+                                for user_id, count in counts.items()),
+                           settings.NOTIFICATION_CACHE_TIMEOUT)
+            rebuilt += len(chunk)
+
+        self.stdout.write("Rebuilt the unseen counters of %d users.\n" % rebuilt)
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.mail import get_connection
+from django.core.management.base import NoArgsCommand
+
+from notification.models import Notice
+
+
+class Command(NoArgsCommand):
+    help = "Emails each user one digest of their notices pending digest."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+            help="Number of users whose digests are built at once."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        connection = get_connection()
+        connection.open()
+        sent = 0
+        last_recipient = 0
+        try:
+            while True:
+                recipient_ids = list(Notice.objects.filter(
+                    pending_digest=True,
+                    recipient__gt=last_recipient
+                ).order_by("recipient").values_list(
+                    "recipient", flat=True).distinct()[:options["batch_size"]])
+                if not recipient_ids:
+                    break
+                last_recipient = recipient_ids[-1]
+                sent += Notice.objects.send_digests(recipient_ids, connection)
+                if verbosity > 1:
+                    self.stdout.write("Sent %d digests so far.\n" % sent)
+        finally:
+            connection.close()
+
+        self.stdout.write("Sent %d digests.\n" % sent)
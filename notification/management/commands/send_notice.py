@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from notification.conf import settings
+from notification.models import NoticeType
+from notification.tasks import notify
+
+
+class Command(BaseCommand):
+    args = "<label> [username ...]"
+    help = ("Sends the notice of type <label> to the given users, or to all "
+            "the active users with --all, delivering in this process.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--all", action="store_true", dest="all", default=False,
+            help="Send to all the active users."),
+        make_option("--concurrency", type="int", dest="concurrency", default=None,
+            help="Number of threads delivering each medium at once, "
+                 "instead of NOTIFICATION_CONCURRENCY."),
+        make_option("--no-site", action="store_false", dest="on_site", default=True,
+            help="Don't display the notice on the site."),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Enter the label of a notice type.")
+        label, usernames = args[0], args[1:]
+        if not NoticeType.objects.filter(label=label).exists():
+            raise CommandError("Unknown notice type %r." % label)
+
+        if options["all"]:
+            users = User.objects.filter(is_active=True)
+        elif usernames:
+            users = User.objects.filter(username__in=usernames)
+        else:
+            raise CommandError("Enter usernames or use --all.")
+        users = list(users.order_by("pk").values_list("pk", flat=True))
+
+        concurrency = None
+        if options["concurrency"] is not None:
+            concurrency = dict((medium, options["concurrency"])
+                               for medium, display in settings.NOTIFICATION_MEDIA)
+
+        notify(users, label, on_site=options["on_site"], concurrency=concurrency)
+
+        if int(options.get("verbosity", 1)) > 0:
+            self.stdout.write("Sent %s to %d users.\n" % (label, len(users)))
@@ -0,0 +1,18 @@
+from notification.models import Notice
+from notification.utils import start_seen_buffer
+
+
+class SeenNoticesMiddleware(object):
+    """
+    Defers the updates made by ``Notice.is_unseen`` while handling a request
+    and runs them as a single UPDATE once the response is ready.
+
+    Set NOTIFICATION_DEFER_SEEN to False to update notices immediately.
+    """
+
+    def process_request(self, request):
+        start_seen_buffer()
+
+    def process_response(self, request, response):
+        Notice.objects.flush_seen()
+        return response
@@ -1,25 +1,130 @@
+import time
+import uuid
+import hashlib
 import logging
 import datetime
+import operator
+from functools import reduce
+from itertools import groupby
 
+import django
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.template.loader import render_to_string
-
-try:
-    from django.utils.timezone import now
-except ImportError:
-    now = datetime.datetime.now
+from django.utils.timezone import now
 
 from notification.conf import settings
-from notification.utils import NotificationContext, get_formatted_messages
+from notification.ratelimit import rate_limited, get_overflow_policy
+from notification.utils import NotificationContext, get_formatted_messages, \
+    context_language, chunked, inline_css, encode_cursor, decode_cursor, \
+    buffer_seen, stop_seen_buffer, send_email_messages, cache_lock, \
+    has_shared_cache
 
 logger = logging.getLogger('notification')
 
+# holds the version of the shared notice types, themselves under
+# "<key>:<version>"
+NOTICE_TYPES_CACHE_KEY = "notification:notice_types"
+
+# bump when the format of the cached settings matrices changes
+SETTINGS_MATRIX_VERSION = 2
+# version, fingerprint of NOTIFICATION_MEDIA, which the layout depends on,
+# and user id
+SETTINGS_MATRIX_CACHE_KEY = "notification:settings:%s:%s:%s"
+
+UNSEEN_COUNT_CACHE_KEY = "notification:unseen:%s"
+
+COALESCE_LOCK_CACHE_KEY = "notification:coalesce:%s:%s"
+
+# composite indexes matching the lookups of NoticeManager.get_for: unseen
+# counts, notice lists and feeds (all notices) ordered by date and sent
+# notices, and the notices pending digest, scanned by recipient by
+# send_digests, and the recent notices of a group, looked up to coalesce them
+NOTICE_INDEXES = [
+    ("recipient", "archived", "on_site", "unseen", "added"),
+    ("recipient", "archived", "on_site", "added", "id"),
+    ("recipient", "archived", "added", "id"),
+    ("sender", "archived", "added"),
+    ("pending_digest", "recipient", "added"),
+    ("recipient", "notice_type", "group_key", "added"),
+]
+
 
 class NoticeTypeManager(models.Manager):
+    # State shared by all instances of the manager: a map of labels to
+    # NoticeType instances, the version of the shared cache it was loaded
+    # from and the time it was loaded at.
+    _cache = {}
+    _cache_version = None
+    _cache_loaded = 0
+
+    def get_by_label(self, label):
+        """
+        Returns the NoticeType with the given label, using a process-local
+        cache. Raises ``NoticeType.DoesNotExist`` for unknown labels.
+
+        The caches are cleared whenever a NoticeType is saved or deleted. If
+        ``NOTIFICATION_USE_CACHE`` is set, the types are shared through
+        Django's cache and each lookup checks that the version of the shared
+        cache, removed on changes, is still the one loaded. Otherwise the
+        local cache is reloaded every ``NOTIFICATION_LOCAL_CACHE_TIMEOUT``
+        seconds, changes made by other processes not being noticed sooner.
+        """
+        manager_class = self.__class__
+        if settings.NOTIFICATION_USE_CACHE:
+            version = cache.get(NOTICE_TYPES_CACHE_KEY)
+            if version is None or version != manager_class._cache_version:
+                self._load(version)
+        elif (not manager_class._cache_version or time.time() >
+              manager_class._cache_loaded + settings.NOTIFICATION_LOCAL_CACHE_TIMEOUT):
+            self._load(None)
+        cache_ = manager_class._cache
+        try:
+            return cache_[label]
+        except KeyError:
+            # the type may have been created by another process
+            notice_type = self.get(label=label)
+            cache_[label] = notice_type
+            return notice_type
+
+    def _load(self, version):
+        """
+        loads the label map of ``version`` of the shared cache, making a new
+        version if it is None or missing.
+        """
+        label_map = None
+        if version is not None:
+            label_map = cache.get("%s:%s" % (NOTICE_TYPES_CACHE_KEY, version))
+        if label_map is None:
+            label_map = dict((notice_type.label, notice_type)
+                             for notice_type in self.all())
+            if settings.NOTIFICATION_USE_CACHE:
+                version = uuid.uuid4().hex
+                cache.set("%s:%s" % (NOTICE_TYPES_CACHE_KEY, version), label_map,
+                          settings.NOTIFICATION_CACHE_TIMEOUT)
+                cache.set(NOTICE_TYPES_CACHE_KEY, version,
+                          settings.NOTIFICATION_CACHE_TIMEOUT)
+        manager_class = self.__class__
+        manager_class._cache = label_map
+        manager_class._cache_version = version or True
+        manager_class._cache_loaded = time.time()
+
+    def clear_cache(self):
+        """
+        Clears the NoticeType cache.
+        """
+        manager_class = self.__class__
+        manager_class._cache = {}
+        manager_class._cache_version = None
+        if settings.NOTIFICATION_USE_CACHE:
+            cache.delete(NOTICE_TYPES_CACHE_KEY)
+
     def create_notice_type(self, label, display, description, default=2, verbosity=1):
         """
         Creates a new NoticeType.
@@ -79,8 +184,30 @@ class NoticeType(models.Model):
         verbose_name_plural = _("notice types")
 
 
+def clear_notice_type_cache(sender, **kwargs):
+    NoticeType.objects.clear_cache()
+post_save.connect(clear_notice_type_cache, sender=NoticeType)
+post_delete.connect(clear_notice_type_cache, sender=NoticeType)
+
+
 class NoticeSettingManager(models.Manager):
+    def get_default(self, notice_type, medium):
+        """
+        Returns whether notices of ``notice_type`` are sent through
+        ``medium`` when the user has no setting for it. Mediums missing from
+        NOTIFICATION_MEDIA_DEFAULTS are off by default.
+        """
+        default = settings.NOTIFICATION_MEDIA_DEFAULTS.get(medium)
+        if default is None:
+            return False
+        return default <= notice_type.default
+
     def get_for(self, user, notice_type, medium):
+        """
+        Returns the NoticeSetting of ``user`` for ``notice_type`` and
+        ``medium``. If none is stored, a default one is created; it is only
+        saved when ``NOTIFICATION_SPARSE_SETTINGS`` is off.
+        """
         try:
             setting = self.model.objects.get(
                 user=user,
@@ -88,16 +215,189 @@ class NoticeSettingManager(models.Manager):
                 medium=medium
             )
         except self.model.DoesNotExist:
-            default = (settings.NOTIFICATION_MEDIA_DEFAULTS[medium] <= notice_type.default)
             setting = self.model(
                 user=user,
                 notice_type=notice_type,
                 medium=medium,
-                send=default
+                send=self.get_default(notice_type, medium)
             )
-            setting.save()
+            if not settings.NOTIFICATION_SPARSE_SETTINGS:
+                setting.save()
         return setting
 
+    def defaults(self):
+        """
+        Returns a queryset of the stored settings that equal their default.
+        """
+        queries = []
+        for notice_type in NoticeType.objects.all():
+            for medium, display in settings.NOTIFICATION_MEDIA:
+                queries.append(models.Q(
+                    notice_type=notice_type,
+                    medium=medium,
+                    send=self.get_default(notice_type, medium)
+                ))
+        if not queries:
+            return self.none()
+        return self.filter(reduce(operator.or_, queries))
+
+    def should_send(self, user, notice_type, medium):
+        """
+        Returns whether notices of ``notice_type`` should be sent to ``user``
+        through ``medium``, reading the cached settings matrix of the user if
+        ``NOTIFICATION_USE_CACHE`` is set.
+        """
+        if not settings.NOTIFICATION_USE_CACHE:
+            return self.get_for(user, notice_type, medium).send
+        matrix = self.get_matrices([user.pk])[user.pk]
+        return self._matrix_send(matrix, notice_type, medium)
+
+    def send_map(self, users, notice_type, medium):
+        """
+        Returns a dictionary mapping the id of each given user to whether
+        notices of ``notice_type`` should be sent to them through ``medium``.
+
+        Stored settings are fetched with a single query, or read from the
+        cached settings matrices if ``NOTIFICATION_USE_CACHE`` is set. Users
+        without a stored setting get the default, which is not saved.
+        """
+        user_ids = [user.pk for user in users]
+        if settings.NOTIFICATION_USE_CACHE:
+            matrices = self.get_matrices(user_ids)
+            return dict((user_id, self._matrix_send(matrices[user_id], notice_type, medium))
+                        for user_id in user_ids)
+        send_map = dict.fromkeys(user_ids, self.get_default(notice_type, medium))
+        send_map.update(self.filter(
+            user__in=user_ids,
+            notice_type=notice_type,
+            medium=medium
+        ).values_list("user", "send"))
+        return send_map
+
+    def get_map(self, user, notice_types):
+        """
+        Returns a dictionary mapping (notice type id, medium) pairs to whether
+        notices of that type should be sent to ``user`` through that medium,
+        for each of ``notice_types`` and each medium. Costs at most one query.
+        """
+        if settings.NOTIFICATION_USE_CACHE:
+            matrix = self.get_matrices([user.pk])[user.pk]
+        else:
+            stored = dict(((notice_type_id, medium), send)
+                          for notice_type_id, medium, send in self.filter(user=user)
+                          .values_list("notice_type", "medium", "send"))
+        send_map = {}
+        for notice_type in notice_types:
+            for medium, medium_display in settings.NOTIFICATION_MEDIA:
+                key = (notice_type.pk, medium)
+                if settings.NOTIFICATION_USE_CACHE:
+                    send_map[key] = self._matrix_send(matrix, notice_type, medium)
+                elif key in stored:
+                    send_map[key] = stored[key]
+                else:
+                    send_map[key] = self.get_default(notice_type, medium)
+        return send_map
+
+    def set_many(self, user, values):
+        """
+        Stores settings of ``user``. ``values`` maps (notice type, medium)
+        pairs to booleans.
+
+        Runs a constant number of queries: one to fetch the stored settings,
+        then at most one bulk insert and one update per value. With
+        ``NOTIFICATION_SPARSE_SETTINGS`` settings set back to their default
+        are deleted with a single query instead.
+        """
+        sparse = settings.NOTIFICATION_SPARSE_SETTINGS
+        stored = dict(((notice_type_id, medium), (pk, send))
+                      for pk, notice_type_id, medium, send in self.filter(user=user)
+                      .values_list("pk", "notice_type", "medium", "send"))
+        updates = {True: [], False: []}
+        to_delete = []
+        to_create = []
+        for (notice_type, medium), send in values.items():
+            is_default = send == self.get_default(notice_type, medium)
+            key = (notice_type.pk, medium)
+            if key in stored:
+                pk, stored_send = stored[key]
+                if sparse and is_default:
+                    to_delete.append(pk)
+                elif send != stored_send:
+                    updates[send].append(pk)
+            elif not (sparse and is_default):
+                to_create.append(self.model(
+                    user=user,
+                    notice_type=notice_type,
+                    medium=medium,
+                    send=send
+                ))
+        for send, pks in updates.items():
+            if pks:
+                self.filter(pk__in=pks).update(send=send)
+        if to_delete:
+            self.filter(pk__in=to_delete).delete()
+        if to_create:
+            self.bulk_create(to_create)
+        # bulk operations don't send the signals clearing the matrix
+        if settings.NOTIFICATION_USE_CACHE:
+            self.clear_cache([user.pk])
+
+    def get_matrices(self, user_ids):
+        """
+        Returns a dictionary mapping each user id to the settings matrix of
+        that user: a pair of bitsets over (notice type, medium), the first
+        flagging the stored settings and the second those set to send.
+
+        Matrices are kept in Django's cache; the missing ones are rebuilt
+        with a single query. Defaults are not part of the matrix, so changing
+        the default of a NoticeType needs no invalidation.
+        """
+        keys = dict((self._matrix_key(user_id), user_id) for user_id in user_ids)
+        matrices = dict((keys[key], matrix)
+                        for key, matrix in cache.get_many(keys.keys()).items())
+        missing = [user_id for user_id in keys.values() if user_id not in matrices]
+        if missing:
+            built = dict((user_id, (0, 0)) for user_id in missing)
+            rows = self.filter(user__in=missing).values_list(
+                "user", "notice_type", "medium", "send")
+            media = set(medium_id for medium_id, medium_display
+                        in settings.NOTIFICATION_MEDIA)
+            for user_id, notice_type_id, medium, send in rows:
+                if medium not in media:
+                    # left from a medium no longer configured
+                    continue
+                stored, sends = built[user_id]
+                bit = self._matrix_bit(notice_type_id, medium)
+                built[user_id] = (stored | bit, sends | bit if send else sends)
+            cache.set_many(dict((self._matrix_key(user_id), matrix)
+                                for user_id, matrix in built.items()),
+                           settings.NOTIFICATION_CACHE_TIMEOUT)
+            matrices.update(built)
+        return matrices
+
+    def clear_cache(self, user_ids):
+        """
+        Clears the cached settings matrices of the given users.
+        """
+        cache.delete_many([self._matrix_key(user_id) for user_id in user_ids])
+
+    def _matrix_key(self, user_id):
+        media = ",".join(medium_id for medium_id, medium_display
+                         in settings.NOTIFICATION_MEDIA)
+        return SETTINGS_MATRIX_CACHE_KEY % (SETTINGS_MATRIX_VERSION,
+            hashlib.md5(media.encode("utf-8")).hexdigest()[:8], user_id)
+
+    def _matrix_bit(self, notice_type_id, medium):
+        media = [medium_id for medium_id, medium_display in settings.NOTIFICATION_MEDIA]
+        return 1 << (notice_type_id * len(media) + media.index(medium))
+
+    def _matrix_send(self, matrix, notice_type, medium):
+        stored, sends = matrix
+        bit = self._matrix_bit(notice_type.pk, medium)
+        if stored & bit:
+            return bool(sends & bit)
+        return self.get_default(notice_type, medium)
+
 
 class NoticeSetting(models.Model):
     """
@@ -119,6 +419,13 @@ class NoticeSetting(models.Model):
         unique_together = ("user", "notice_type", "medium")
 
 
+def clear_notice_setting_cache(sender, instance, **kwargs):
+    if settings.NOTIFICATION_USE_CACHE:
+        NoticeSetting.objects.clear_cache([instance.user_id])
+post_save.connect(clear_notice_setting_cache, sender=NoticeSetting)
+post_delete.connect(clear_notice_setting_cache, sender=NoticeSetting)
+
+
 class NoticeManager(models.Manager):
 
     def get_for(self, user, archived=False, unseen=None, on_site=None, sent=False):
@@ -138,13 +445,15 @@ class NoticeManager(models.Manager):
             lookup_kwargs = {"recipient": user}
         qs = self.filter(**lookup_kwargs)
         if not archived:
-            self.filter(archived=archived)
+            qs = qs.filter(archived=archived)
         if unseen is not None:
             qs = qs.filter(unseen=unseen)
         if on_site is not None:
             qs = qs.filter(on_site=on_site)
         return qs
 
+    notices_for = get_for
+
     def unseen_count_for(self, recipient, **kwargs):
         """
         returns the number of unseen notices for the given user but does not
@@ -152,6 +461,150 @@ class NoticeManager(models.Manager):
         """
         return self.notices_for(recipient, unseen=True, **kwargs).count()
 
+    def unseen_count(self, recipient):
+        """
+        returns the number of unseen, unarchived on-site notices for the given
+        user.
+
+        If NOTIFICATION_USE_CACHE is set, the number is kept in a cached
+        counter updated as notices are created, seen, archived and deleted,
+        and only counted in the database when missing from the cache.
+        """
+        if not settings.NOTIFICATION_USE_CACHE:
+            return self.unseen_count_for(recipient, on_site=True)
+        key = UNSEEN_COUNT_CACHE_KEY % recipient.pk
+        count = cache.get(key)
+        if count is None:
+            count = self.unseen_count_for(recipient, on_site=True)
+            cache.add(key, count, settings.NOTIFICATION_CACHE_TIMEOUT)
+        return max(count, 0)
+
+    def update_unseen_count(self, recipient_id, delta):
+        """
+        adds ``delta`` to the cached unseen counter of the given user, if
+        there is one.
+        """
+        if not settings.NOTIFICATION_USE_CACHE or not delta:
+            return
+        key = UNSEEN_COUNT_CACHE_KEY % recipient_id
+        try:
+            if delta > 0:
+                cache.incr(key, delta)
+            else:
+                cache.decr(key, -delta)
+        except ValueError:
+            # not cached, it will be counted on the next read
+            pass
+
+    def clear_unseen_count(self, recipient_ids):
+        """
+        clears the cached unseen counters of the given users.
+        """
+        if settings.NOTIFICATION_USE_CACHE:
+            cache.delete_many([UNSEEN_COUNT_CACHE_KEY % recipient_id
+                               for recipient_id in recipient_ids])
+
+    def _for_recipient(self, user, ids):
+        qs = self.all()
+        if user is not None:
+            qs = qs.filter(recipient=user)
+        if ids is not None:
+            qs = qs.filter(pk__in=ids)
+        return qs
+
+    def _clear_unseen_count_of(self, user, qs):
+        if not settings.NOTIFICATION_USE_CACHE:
+            return
+        if user is not None:
+            self.clear_unseen_count([user.pk])
+        else:
+            self.clear_unseen_count(set(qs.values_list("recipient", flat=True)))
+
+    def mark_seen(self, user, ids=None):
+        """
+        marks the unseen notices of the given user seen, or only those whose
+        id is in ``ids``, with a single UPDATE. With ``user`` None, the
+        notices of all users whose id is in ``ids`` are marked. Returns the
+        number of notices marked.
+        """
+        qs = self._for_recipient(user, ids).filter(unseen=True)
+        self._clear_unseen_count_of(user, qs)
+        return qs.update(unseen=False)
+
+    def flush_seen(self):
+        """
+        marks seen, with a single UPDATE, the notices buffered by is_unseen
+        in the current thread and stops buffering. Returns the number of
+        notices marked.
+        """
+        seen = stop_seen_buffer()
+        if not seen:
+            return 0
+        count = self.filter(pk__in=seen.keys(), unseen=True).update(unseen=False)
+        self.clear_unseen_count(set(seen.values()))
+        return count
+
+    def archive_many(self, user, ids):
+        """
+        archives the notices whose id is in ``ids`` with a single UPDATE.
+        Only the notices of the given user are archived, unless it is
+        ``None``. Returns the number of notices archived.
+        """
+        qs = self._for_recipient(user, ids).filter(archived=False)
+        self._clear_unseen_count_of(user, qs)
+        return qs.update(archived=True)
+
+    def delete_many(self, user, ids):
+        """
+        deletes the notices whose id is in ``ids`` with a single DELETE.
+        Only the notices of the given user are deleted, unless it is
+        ``None``. Returns the number of notices deleted.
+        """
+        qs = self._for_recipient(user, ids)
+        pks = list(qs.values_list("pk", flat=True))
+        if pks:
+            # the unseen counters are updated by the post_delete receiver
+            self.filter(pk__in=pks).delete()
+        return len(pks)
+
+    def page_queryset(self, user, cursor=None, **kwargs):
+        """
+        returns the notices of ``page_after``, newest first, following the
+        notice ``cursor`` points to, without limit.
+        """
+        qs = self.get_for(user, **kwargs).select_related(
+            "notice_type", "sender").order_by("-added", "-pk")
+        if cursor:
+            added, pk = decode_cursor(cursor)
+            # added__lte gives the index a range bound, the OR alone doesn't
+            qs = qs.filter(models.Q(added__lt=added) |
+                           models.Q(added=added, pk__lt=pk),
+                           added__lte=added)
+        return qs
+
+    def page_after(self, user, cursor=None, limit=20, **kwargs):
+        """
+        returns a page of at most ``limit`` notices for the given user, newest
+        first, following the notice ``cursor`` points to, and the cursor of
+        the next page or None if it is the last one. Other keyword arguments
+        are passed to get_for.
+
+        The page is selected with a (added, id) condition rather than an
+        OFFSET, so any page costs as much as the first one, as long as the
+        lookups match one of NOTICE_INDEXES (e.g. ``on_site=True``). Notice
+        types and senders are fetched along. Raises ValueError for invalid
+        cursors.
+        """
+        qs = self.page_queryset(user, cursor, **kwargs)
+        notices = list(qs[:limit + 1])
+        for notice in notices:
+            notice.recipient = user
+        next_cursor = None
+        if len(notices) > limit:
+            notices = notices[:limit]
+            next_cursor = encode_cursor(notices[-1])
+        return notices, next_cursor
+
     def received(self, recipient, **kwargs):
         """
         returns notices the given recipient has recieved.
@@ -166,13 +619,8 @@ class NoticeManager(models.Manager):
         kwargs["sent"] = True
         return self.notices_for(sender, **kwargs)
 
-    def create_notice(self, user, label, extra_context=None, on_site=True,
-                      sender=None):
-        if extra_context is None:
-            extra_context = {}
-
-        notice_type = NoticeType.objects.get(label=label)
-
+    def _build_notice(self, user, notice_type, extra_context, on_site, sender,
+                      batch_id="", group_key=""):
         formats = (
             "notice.html",
         )
@@ -184,19 +632,243 @@ class NoticeManager(models.Manager):
         context.update(extra_context)
 
         # get prerendered format messages
-        messages = get_formatted_messages(formats, label, context)
+        messages = get_formatted_messages(formats, notice_type.label, context)
 
-        notice = self.model(
+        return self.model(
             recipient=user,
             message=messages["notice.html"],
             notice_type=notice_type,
             on_site=on_site,
-            sender=sender
+            sender=sender,
+            batch_id=batch_id,
+            group_key=group_key
         )
+
+    def digest_recipients(self, users, notice_type):
+        """
+        returns the ids of the users receiving notices of ``notice_type`` in
+        their digest.
+        """
+        from notification.api import filter_can_send
+        medium = settings.NOTIFICATION_DIGEST_MEDIUM
+        if medium not in dict(settings.NOTIFICATION_MEDIA):
+            return set()
+        return set(user.pk for user in filter_can_send(users, notice_type, medium))
+
+    def send_digests(self, recipient_ids, connection, from_email=None):
+        """
+        emails each of the given users a single digest of their notices
+        pending digest, through ``connection``, and clears their
+        ``pending_digest`` flag. Returns the number of digests sent.
+        """
+        from django.core.mail.message import EmailMessage
+        from notification.api import can_receive
+
+        if from_email is None:
+            from_email = settings.DEFAULT_FROM_EMAIL
+
+        notices = self.filter(
+            pending_digest=True,
+            recipient__in=recipient_ids
+        ).select_related("recipient", "sender", "notice_type").order_by("recipient", "added")
+
+        messages = []
+        pks = []
+        for user, user_notices in groupby(notices, key=lambda notice: notice.recipient):
+            user_notices = list(user_notices)
+            pks.extend(notice.pk for notice in user_notices)
+            if not can_receive(user, settings.NOTIFICATION_DIGEST_MEDIUM):
+                continue
+            with context_language(user):
+                context = NotificationContext({
+                    "recipient": user,
+                    "notices": user_notices,
+                })
+                context.autoescape = False
+                # Strip newlines from subject
+                subject = "".join(render_to_string(
+                    "notification/digest_subject.txt", {}, context).splitlines())
+                subject = u'%s%s' % (settings.EMAIL_SUBJECT_PREFIX, subject)
+                body = render_to_string("notification/digest_body.txt", {}, context)
+            messages.append(EmailMessage(subject, body, from_email, [user.email]))
+
+        send_email_messages(messages, connection)
+        if pks:
+            self.filter(pk__in=pks).update(pending_digest=False)
+        return len(messages)
+
+    def create_notice(self, user, label, extra_context=None, on_site=True,
+                      sender=None):
+        if extra_context is None:
+            extra_context = {}
+
+        notice_type = NoticeType.objects.get_by_label(label)
+
+        notice = self._build_notice(user, notice_type, extra_context, on_site,
+                                    sender)
+        notice.pending_digest = bool(self.digest_recipients([user], notice_type))
         notice.save()
+        if notice.counts_as_unseen():
+            self.update_unseen_count(user.pk, 1)
 
         return notice
 
+    def create_notices(self, users, label, extra_context=None, on_site=True,
+                       sender=None, batch_size=None, batch_id="",
+                       group_key="", digest_recipients=None):
+        """
+        Creates a notice for each of the given users.
+
+        The notice type is looked up once, each notice is rendered in its
+        recipient's language and the rows are written with ``bulk_create``
+        in chunks of ``batch_size`` (``NOTIFICATION_BATCH_SIZE`` by default).
+
+        Notices of users receiving digests are flagged ``pending_digest``.
+        ``digest_recipients``, a set of user ids, overrides who they are.
+
+        If ``batch_id`` is given, the notices are tagged with it and users who
+        already have a notice with the same ``batch_id`` are skipped, so that
+        running the same batch twice doesn't create duplicates.
+
+        If ``group_key`` is given and NOTIFICATION_COALESCE_WINDOW is set,
+        users who received a notice of the same type and ``group_key`` within
+        the window get that notice updated instead of a new one: its count is
+        incremented, its sender replaced and its message rendered again with
+        ``notice_count`` in the context. Archived notices, and notices whose
+        ``on_site`` differs, are left alone. Coalesced notices are not
+        returned. Raises ``notification.utils.LockTimeout`` if another
+        worker holds the group for too long, and ImproperlyConfigured if the
+        cache can't hold locks shared by processes.
+
+        Returns the list of created notices, fetched back from the database
+        if ``bulk_create`` didn't set their primary keys. Notices created
+        without ``batch_id`` get a unique one to that end.
+        """
+        if extra_context is None:
+            extra_context = {}
+        if batch_size is None:
+            batch_size = settings.NOTIFICATION_BATCH_SIZE
+
+        notice_type = NoticeType.objects.get_by_label(label)
+
+        if batch_id:
+            tag = batch_id
+        else:
+            tag = uuid.uuid4().hex
+
+        coalesce = bool(group_key and settings.NOTIFICATION_COALESCE_WINDOW)
+        if coalesce and not has_shared_cache():
+            raise ImproperlyConfigured("NOTIFICATION_COALESCE_WINDOW needs a "
+                "cache backend shared by all processes to lock groups.")
+
+        created = []
+        for chunk in chunked(users, batch_size):
+            if batch_id:
+                done = set(self.filter(
+                    batch_id=batch_id,
+                    recipient__in=[user.pk for user in chunk]
+                ).values_list("recipient", flat=True))
+                chunk = [user for user in chunk if user.pk not in done]
+            if coalesce:
+                # serializes the workers notifying the same group
+                with cache_lock(COALESCE_LOCK_CACHE_KEY % (notice_type.pk, group_key)):
+                    chunk = self._coalesce(chunk, notice_type, extra_context,
+                                           on_site, sender, group_key, tag,
+                                           digest_recipients)
+                    created.extend(self._insert_notices(chunk, notice_type,
+                        extra_context, on_site, sender, tag, group_key,
+                        digest_recipients))
+            else:
+                created.extend(self._insert_notices(chunk, notice_type,
+                    extra_context, on_site, sender, tag, group_key,
+                    digest_recipients))
+
+        return created
+
+    def _insert_notices(self, users, notice_type, extra_context, on_site,
+                        sender, batch_id, group_key, digest_recipients=None):
+        notices = []
+        for user in users:
+            with context_language(user):
+                notices.append(self._build_notice(user, notice_type,
+                    extra_context, on_site, sender, batch_id, group_key))
+        if digest_recipients is None:
+            digest_recipients = self.digest_recipients(users, notice_type)
+        for notice in notices:
+            notice.pending_digest = notice.recipient_id in digest_recipients
+        self.bulk_create(notices)
+        if on_site:
+            for user in users:
+                self.update_unseen_count(user.pk, 1)
+        if notices and notices[0].pk is None:
+            notices = self._fetch_inserted(users, notice_type, sender, batch_id)
+        return notices
+
+    def _fetch_inserted(self, users, notice_type, sender, batch_id):
+        """
+        returns the notices of ``batch_id`` just inserted for ``users``, in
+        the order of ``users``, with their related objects set.
+        """
+        notices = dict((notice.recipient_id, notice) for notice in self.filter(
+            batch_id=batch_id,
+            recipient__in=[user.pk for user in users]
+        ))
+        fetched = []
+        for user in users:
+            notice = notices.get(user.pk)
+            if notice is None:
+                continue
+            notice.recipient = user
+            notice.notice_type = notice_type
+            notice.sender = sender
+            fetched.append(notice)
+        return fetched
+
+    def _coalesce(self, users, notice_type, extra_context, on_site, sender,
+                  group_key, batch_id, digest_recipients=None):
+        """
+        updates the unarchived notices of ``users`` sharing ``notice_type``,
+        ``on_site`` and ``group_key`` added within NOTIFICATION_COALESCE_WINDOW
+        and returns the users who have none. Updated notices get
+        ``batch_id`` so that retrying the batch doesn't count them twice.
+        """
+        since = now() - datetime.timedelta(seconds=settings.NOTIFICATION_COALESCE_WINDOW)
+        # ordered by date so that the latest notice of each user wins
+        recent = dict((recipient_id, (pk, count))
+                      for recipient_id, pk, count in self.filter(
+                          recipient__in=[user.pk for user in users],
+                          notice_type=notice_type,
+                          group_key=group_key,
+                          on_site=on_site,
+                          archived=False,
+                          added__gte=since
+                      ).order_by("added").values_list("recipient", "pk", "count"))
+        if not recent:
+            return users
+
+        if digest_recipients is None:
+            digest_recipients = self.digest_recipients(
+                [user for user in users if user.pk in recent], notice_type)
+        for user in users:
+            if user.pk not in recent:
+                continue
+            pk, count = recent[user.pk]
+            context = dict(extra_context, notice_count=count + 1)
+            with context_language(user):
+                notice = self._build_notice(user, notice_type, context, on_site,
+                                            sender)
+            self.filter(pk=pk).update(
+                count=models.F("count") + 1,
+                sender=sender,
+                message=notice.message,
+                unseen=True,
+                batch_id=batch_id,
+                # the digest may have been sent since
+                pending_digest=user.pk in digest_recipients
+            )
+        self.clear_unseen_count(recent.keys())
+        return [user for user in users if user.pk not in recent]
+
 
 class Notice(models.Model):
     recipient = models.ForeignKey(User, related_name="recieved_notices",
@@ -209,6 +881,15 @@ class Notice(models.Model):
     unseen = models.BooleanField(_("unseen"), default=True)
     archived = models.BooleanField(_("archived"), default=False)
     on_site = models.BooleanField(_("on site"))
+    # identifies the notify call that created the notice, see create_notices
+    batch_id = models.CharField(_("batch id"), max_length=32, blank=True,
+                                db_index=True, editable=False)
+    # whether the notice is waiting to be emailed in a digest
+    pending_digest = models.BooleanField(_("pending digest"), default=False)
+    # notices of the same type and group key are coalesced, see create_notices
+    group_key = models.CharField(_("group key"), max_length=100, blank=True,
+                                 editable=False)
+    count = models.PositiveIntegerField(_("count"), default=1, editable=False)
 
     objects = NoticeManager()
 
@@ -216,6 +897,10 @@ class Notice(models.Model):
         ordering = ["-added"]
         verbose_name = _("notice")
         verbose_name_plural = _("notices")
+        # older versions don't support index_together, see the
+        # notice_indexes command
+        if django.VERSION >= (1, 5):
+            index_together = NOTICE_INDEXES
 
     def __unicode__(self):
         return self.message
@@ -224,9 +909,30 @@ class Notice(models.Model):
     def get_absolute_url(self):
         return "notification_notice", [str(self.pk)]
 
+    def counts_as_unseen(self):
+        """
+        returns whether the notice is part of the unseen count of its
+        recipient.
+        """
+        return self.unseen and self.on_site and not self.archived
+
     def archive(self):
+        counted = self.counts_as_unseen()
         self.archived = True
-        self.save()
+        Notice.objects.filter(pk=self.pk).update(archived=True)
+        if counted:
+            Notice.objects.update_unseen_count(self.recipient_id, -1)
+
+    def mark_seen(self):
+        """
+        marks the notice seen.
+        """
+        if self.unseen:
+            counted = self.counts_as_unseen()
+            self.unseen = False
+            Notice.objects.filter(pk=self.pk).update(unseen=False)
+            if counted:
+                Notice.objects.update_unseen_count(self.recipient_id, -1)
 
     def is_unseen(self):
         """
@@ -234,18 +940,65 @@ class Notice(models.Model):
 
         Use this in a template to mark an unseen notice differently the first
         time it is shown.
+
+        With NOTIFICATION_DEFER_SEEN and SeenNoticesMiddleware, the notice is
+        only updated at the end of the request, along with the others.
         """
         unseen = self.unseen
-        if unseen:
+        if unseen and settings.NOTIFICATION_DEFER_SEEN and buffer_seen(self):
             self.unseen = False
-            self.save()
+        else:
+            self.mark_seen()
         return unseen
 
     def can_send(self, medium):
         from notification.api import can_send
         return can_send(self.recipient, self.notice_type, medium)
 
-    def send(self, extra_context=None, from_email=None, headers=None):
+    def send(self, extra_context=None, from_email=None, headers=None,
+             check_settings=True, connection=None):
+        """
+        Delivers the notice through the backend of each medium, by email over
+        ``connection`` if given.
+
+        Pass ``check_settings=False`` if the recipient's settings have already
+        been checked, e.g. with ``notification.api.filter_can_send``.
+        """
+        from notification.backends import get_backends
+
+        if self.pending_digest:
+            # held back for the digest
+            return
+
+        backends = get_backends(extra_context=extra_context,
+                                from_email=from_email, headers=headers,
+                                connection=connection)
+        try:
+            deliveries = []
+            for medium, backend in backends:
+                if medium == settings.NOTIFICATION_DIGEST_MEDIUM:
+                    continue
+                if check_settings and not self.can_send(medium=medium):
+                    continue
+                if rate_limited([self.recipient_id], medium, self.notice_type):
+                    if get_overflow_policy() == "digest":
+                        self.pending_digest = True
+                        Notice.objects.filter(pk=self.pk).update(pending_digest=True)
+                        return
+                    continue
+                deliveries.append(backend)
+            for backend in deliveries:
+                backend.send_batch([self])
+        finally:
+            for medium, backend in backends:
+                backend.close()
+
+    def get_email_message(self, extra_context=None, from_email=None,
+                          headers=None, connection=None):
+        """
+        Returns the email message of the notice, without checking the
+        recipient's settings.
+        """
         if extra_context is None:
             extra_context = {}
 
@@ -280,24 +1033,28 @@ class Notice(models.Model):
                 "message": messages["full.txt"],
             }, context)
 
-        if self.can_send(medium="1"):
-            recipients = [user.email]
-
-            if messages['full.html']:
-                from django.core.mail import EmailMultiAlternatives
-                # check if premailer is enabled
-                if settings.NOTIFICATION_USE_PYNLINER:
-                    import pynliner
-                    messages['full.html'] = pynliner.fromString(messages['full.html'])
-                msg = EmailMultiAlternatives(subject, body, from_email, recipients,
-                    headers=headers)
-                msg.attach_alternative(messages['full.html'], "text/html")
-                msg.send()
-            else:
-                from django.core.mail.message import EmailMessage
-                msg = EmailMessage(subject, body, from_email, recipients,
-                    headers=headers)
-                msg.send()
+        recipients = [user.email]
+
+        if messages['full.html']:
+            from django.core.mail import EmailMultiAlternatives
+            # check if premailer is enabled
+            if settings.NOTIFICATION_USE_PYNLINER:
+                messages['full.html'] = inline_css(messages['full.html'])
+            msg = EmailMultiAlternatives(subject, body, from_email, recipients,
+                headers=headers, connection=connection)
+            msg.attach_alternative(messages['full.html'], "text/html")
+        else:
+            from django.core.mail.message import EmailMessage
+            msg = EmailMessage(subject, body, from_email, recipients,
+                headers=headers, connection=connection)
+        return msg
+
+
+def update_unseen_count(sender, instance, **kwargs):
+    # also run for queryset deletes, e.g. in the admin, and cascades
+    if instance.counts_as_unseen():
+        Notice.objects.update_unseen_count(instance.recipient_id, -1)
+post_delete.connect(update_unseen_count, sender=Notice)
 
 
 class ObservedItemManager(models.Manager):
@@ -332,7 +1089,7 @@ class ObservedItemManager(models.Manager):
         To be used by applications to register a user as an observer for
         some object.
         """
-        notice_type = NoticeType.objects.get(label=label)
+        notice_type = NoticeType.objects.get_by_label(label)
         observed_item = self.model(
             user=observer,
             observed_object=observed,
@@ -399,7 +1156,8 @@ class ObservedItem(models.Model):
         if extra_context is None:
             extra_context = {}
         extra_context.update({"observed": self.observed_object})
-        send([self.user], self.notice_type.label, extra_context)
+        send([self.user], self.notice_type.label, extra_context,
+             group_key="observed:%s:%s" % (self.content_type_id, self.object_id))
 
 
 ### DEPRECATED API #####################################################
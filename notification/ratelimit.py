@@ -0,0 +1,115 @@
+"""
+Rate limiting of the notices delivered to each user through each medium.
+
+Limits are declared in NOTIFICATION_RATE_LIMITS, which maps a medium, or a
+(medium, notice type label) pair, to a (number, seconds) pair: at most
+``number`` notices are delivered per ``seconds``. A notice type with its
+own limit has its own bucket, on top of the bucket of the medium.
+"""
+import time
+
+from django.core.cache import cache
+
+from notification.conf import settings
+
+RATE_LIMIT_CACHE_KEY = "notification:rate:%s:%s:%s:%s"
+
+
+def get_limits(medium, notice_type):
+    """
+    Returns the (scope, (number, seconds)) pairs of the buckets notices of
+    ``notice_type`` sent through ``medium`` take a token from: the bucket
+    of the medium and the bucket of the notice type, if configured.
+    """
+    limits = settings.NOTIFICATION_RATE_LIMITS
+    buckets = []
+    if medium in limits:
+        buckets.append(("*", limits[medium]))
+    if (medium, notice_type.label) in limits:
+        buckets.append((notice_type.label, limits[(medium, notice_type.label)]))
+    return buckets
+
+
+def get_overflow_policy():
+    """
+    Returns what happens to the notices over the limit:
+
+        ``"drop"``
+            the notice is neither delivered nor created by ``notify``.
+
+        ``"digest"``
+            the notice is held back for the next digest. Same as
+            ``"on_site"`` when there is no digest medium.
+
+        ``"on_site"``
+            the notice is only shown on the site.
+    """
+    policy = settings.NOTIFICATION_RATE_LIMIT_OVERFLOW
+    if policy == "digest" and settings.NOTIFICATION_DIGEST_MEDIUM not in dict(settings.NOTIFICATION_MEDIA):
+        return "on_site"
+    return policy
+
+
+def rate_limited(user_ids, medium, notice_type):
+    """
+    Takes a token from each bucket of each of the given users for ``medium``
+    and ``notice_type``, and returns the set of ids of the users one of
+    whose buckets was empty. These users keep all their tokens.
+
+    Buckets are counters in Django's cache updated with atomic increments.
+    The number of tokens taken is estimated over a sliding window: the
+    count of the current period plus the part of the count of the previous
+    period that is still within ``seconds``.
+    """
+    limited = set()
+    # user id -> keys of the counters incremented for it
+    taken = {}
+    for scope, (number, seconds) in get_limits(medium, notice_type):
+        now = time.time()
+        period = int(now // seconds)
+        # weight of the previous period in the sliding window
+        weight = 1 - (now % seconds) / float(seconds)
+
+        user_ids = [user_id for user_id in user_ids if user_id not in limited]
+        if not user_ids:
+            break
+        previous_keys = dict((user_id, RATE_LIMIT_CACHE_KEY % (user_id, medium, scope, period - 1))
+                             for user_id in user_ids)
+        previous = cache.get_many(previous_keys.values())
+
+        for user_id in user_ids:
+            key = RATE_LIMIT_CACHE_KEY % (user_id, medium, scope, period)
+            cache.add(key, 0, seconds * 2)
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                # expired in between
+                cache.set(key, 1, seconds * 2)
+                count = 1
+            taken.setdefault(user_id, []).append(key)
+            if previous.get(previous_keys[user_id], 0) * weight + count > number:
+                # give the tokens back, refused deliveries don't count
+                _give_back(taken.pop(user_id))
+                limited.add(user_id)
+    return limited
+
+
+def refund(user_ids, medium, notice_type):
+    """
+    Gives back the tokens taken by ``rate_limited`` for the given users,
+    e.g. when their notices were not delivered after all. Tokens taken in
+    a previous period are given back in the current one.
+    """
+    for scope, (number, seconds) in get_limits(medium, notice_type):
+        period = int(time.time() // seconds)
+        _give_back([RATE_LIMIT_CACHE_KEY % (user_id, medium, scope, period)
+                    for user_id in user_ids])
+
+
+def _give_back(keys):
+    for key in keys:
+        try:
+            if cache.get(key, 0) > 0:
+                cache.decr(key)
+        except ValueError:
+            pass
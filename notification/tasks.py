@@ -1,22 +1,158 @@
-from __future__ import with_statement
+import uuid
 
 from celery.task import task
+try:
+    from celery import group
+except ImportError:  # celery < 3.0
+    from celery.task.sets import TaskSet as group
+
+from notification.conf import settings
+from notification.ratelimit import rate_limited, refund, get_overflow_policy
+from notification.utils import chunked, serialize_context, \
+    deserialize_context, get_pks, get_users
 
 
 @task(ignore_result=True)
 def notify(users, label, extra_context=None, on_site=True, sender=None,
-           from_email=None, headers=None):
+           from_email=None, headers=None, batch_id="", group_key="",
+           concurrency=None):
     """
     Creates a new notice.
 
     You can pass in on_site=False to prevent the notice emitted from being
     displayed on the site.
+
+    ``users`` and ``sender`` may be given as primary keys, and the model
+    instances of ``extra_context`` as references made by
+    ``notification.utils.serialize_context``, as done by ``delay_notify``.
+    Users are then fetched with one query per batch.
+
+    If ``batch_id`` is given, users already notified with the same
+    ``batch_id`` are skipped, which makes retrying the task safe. A failing
+    call is then retried by Celery.
+
+    Notices sharing ``group_key`` may be coalesced, see
+    ``NoticeManager.create_notices``.
+
+    Users are processed in batches of ``NOTIFICATION_BATCH_SIZE``: the notices
+    of a batch are rendered and inserted at once, then handed to the backend
+    of each medium (see ``notification.backends``) in one ``send_batch``
+    call, for the users whose settings allow it. Users receiving digests get
+    the notice in their next digest instead. Deliveries may run
+    concurrently, see ``notification.engine``; ``concurrency`` overrides
+    ``NOTIFICATION_CONCURRENCY``.
+    Users over their rate limit are handled following
+    ``NOTIFICATION_RATE_LIMIT_OVERFLOW``, see ``notification.ratelimit``.
+    """
+    from django.contrib.auth.models import User
+
+    from notification.api import filter_can_send
+    from notification.engine import DeliveryEngine
+    from notification.models import Notice, NoticeType
+
+    retry_args = [users, label, extra_context, on_site, sender, from_email,
+                  headers, batch_id, group_key, concurrency]
+
+    notice_type = NoticeType.objects.get_by_label(label)
+
+    if sender is not None and not isinstance(sender, User):
+        sender = User.objects.in_bulk([sender]).get(sender)
+    context = deserialize_context(extra_context)
+
+    engine = DeliveryEngine(concurrency, extra_context=context,
+                            from_email=from_email, headers=headers)
+    policy = get_overflow_policy()
+    # digests are sent by send_digests
+    media = [medium for medium, backend in engine.backends
+             if medium != settings.NOTIFICATION_DIGEST_MEDIUM]
+    try:
+        try:
+            for chunk in chunked(users, settings.NOTIFICATION_BATCH_SIZE):
+                chunk = get_users(chunk)
+                digest_recipients = Notice.objects.digest_recipients(chunk, notice_type)
+                # medium -> ids of the users to deliver to
+                recipients = {}
+                for medium in media:
+                    recipients[medium] = set(user.pk for user in
+                        filter_can_send(chunk, notice_type, medium))
+                    recipients[medium] -= digest_recipients
+                limited = set()
+                if policy == "drop":
+                    # tokens are taken first to leave out the users over
+                    # their limits of all the mediums
+                    for medium in media:
+                        over = rate_limited(recipients[medium], medium, notice_type)
+                        recipients[medium] -= over
+                        limited |= over
+                    delivered = set().union(*recipients.values())
+                    chunk = [user for user in chunk
+                             if user.pk not in limited or user.pk in delivered]
+                notices = Notice.objects.create_notices(chunk, label, context,
+                                                        on_site, sender,
+                                                        batch_id=batch_id,
+                                                        group_key=group_key,
+                                                        digest_recipients=digest_recipients)
+                # users coalesced or already notified get nothing
+                created = set(notice.recipient_id for notice in notices)
+                for medium in media:
+                    if policy == "drop":
+                        refund(recipients[medium] - created, medium, notice_type)
+                    recipients[medium] &= created
+                    if policy != "drop":
+                        over = rate_limited(recipients[medium], medium, notice_type)
+                        recipients[medium] -= over
+                        limited |= over
+                if limited and policy == "digest":
+                    held = [notice for notice in notices
+                            if notice.recipient_id in limited]
+                    Notice.objects.filter(pk__in=[notice.pk for notice in held]) \
+                        .update(pending_digest=True)
+                    for notice in held:
+                        notice.pending_digest = True
+                for medium in media:
+                    batch = [notice for notice in notices
+                             if notice.recipient_id in recipients[medium]
+                             and not notice.pending_digest]
+                    if batch:
+                        engine.send(medium, batch)
+        finally:
+            engine.close()
+    except Exception as exc:
+        if not batch_id:
+            raise
+        notify.retry(args=retry_args, exc=exc)
+
+
+def notify_in_chunks(users, label, extra_context=None, on_site=True,
+                     sender=None, from_email=None, headers=None,
+                     group_key="", chunk_size=None):
+    """
+    Queues one ``notify`` task per chunk of ``chunk_size`` users
+    (``NOTIFICATION_QUEUE_CHUNK_SIZE`` by default) as a Celery group.
+
+    Users and model instances are passed as in ``delay_notify``. All the
+    tasks share a ``batch_id`` so that each of them can be retried
+    without creating duplicate notices.
+    """
+    if chunk_size is None:
+        chunk_size = settings.NOTIFICATION_QUEUE_CHUNK_SIZE
+    batch_id = uuid.uuid4().hex
+    extra_context = serialize_context(extra_context)
+    sender = getattr(sender, "pk", sender)
+    return group([
+        notify.subtask((chunk, label, extra_context, on_site, sender,
+                        from_email, headers, batch_id, group_key))
+        for chunk in chunked(get_pks(users), chunk_size)
+    ]).apply_async()
+
+
+def delay_notify(users, label, extra_context=None, on_site=True, sender=None,
+                 from_email=None, headers=None, group_key=""):
+    """
+    Queues ``notify`` with the users and the sender as primary keys and the
+    model instances of ``extra_context`` as references, keeping the message
+    small and letting the worker fetch fresh objects.
     """
-    from notification.models import Notice
-    from notification.utils import context_language
-
-    for user in users:
-        with context_language(user):
-            notice = Notice.objects.create_notice(user, label, extra_context,
-                                                  on_site, sender)
-            notice.send(extra_context, from_email, headers)
+    return notify.delay(get_pks(users), label, serialize_context(extra_context),
+                        on_site, getattr(sender, "pk", sender), from_email,
+                        headers, group_key=group_key)
@@ -0,0 +1,241 @@
+import os
+import time
+import asyncore
+import smtpd
+import threading
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from notification.backends import BaseBackend
+from notification.conf import settings
+from notification.engine import DeliveryEngine
+from notification.models import NoticeType
+from notification.tasks import notify
+from notification.views import notice_settings
+
+TEMPLATE_DIRS = (os.path.join(os.path.dirname(__file__), "test_templates"),)
+
+
+def create_notice_types(count):
+    start = NoticeType.objects.count()
+    for i in range(start, start + count):
+        NoticeType.objects.create(label="type_%d" % i, display="Type %d" % i,
+                                  description="Type %d" % i, default=2)
+
+
+@override_settings(TEMPLATE_DIRS=TEMPLATE_DIRS, NOTIFICATION_USE_CACHE=False,
+                   NOTIFICATION_SPARSE_SETTINGS=False)
+class NoticeSettingsViewTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def get(self, user):
+        request = self.factory.get("/settings/")
+        request.user = user
+        return notice_settings(request)
+
+    def post(self, user):
+        data = dict(("%s_1" % label, "on") for label in
+                    NoticeType.objects.values_list("label", flat=True))
+        request = self.factory.post("/settings/", data)
+        request.user = user
+        return notice_settings(request)
+
+    def test_get_query_count(self):
+        # the notice types, then the user's settings
+        for count in (2, 20):
+            create_notice_types(count)
+            user = User.objects.create_user("get_%d" % count, "", "secret")
+            with self.assertNumQueries(2):
+                response = self.get(user)
+            self.assertEqual(response.status_code, 200)
+
+    def test_post_query_count(self):
+        # the notice types, the user's settings twice, then the bulk insert
+        for count in (2, 20):
+            create_notice_types(count)
+            user = User.objects.create_user("post_%d" % count, "", "secret")
+            with self.assertNumQueries(4):
+                response = self.post(user)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(user.noticesetting_set.count(),
+                             NoticeType.objects.count() *
+                             len(settings.NOTIFICATION_MEDIA))
+
+
+class StubSMTPServer(smtpd.SMTPServer):
+    """
+    Records the messages it receives and the client address of each, served
+    by ``asyncore`` in a thread of its own.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append((peer, rcpttos))
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={"timeout": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        asyncore.close_all()
+        self.thread.join()
+
+
+class RecordingBackend(BaseBackend):
+    """
+    Counts the deliveries running at once, each taking a little while.
+    """
+    supports_concurrency = True
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        cls.running = 0
+        cls.max_running = 0
+        cls.delivered = []
+        cls.threads = set()
+
+    def deliver_batch(self, messages):
+        with self.lock:
+            RecordingBackend.running += 1
+            RecordingBackend.max_running = max(RecordingBackend.max_running,
+                                               RecordingBackend.running)
+            RecordingBackend.threads.add(threading.current_thread())
+        time.sleep(0.1)
+        with self.lock:
+            RecordingBackend.running -= 1
+            RecordingBackend.delivered.extend(messages)
+        return len(messages)
+
+
+class FailingBackend(BaseBackend):
+    supports_concurrency = True
+
+    def deliver_batch(self, messages):
+        raise ValueError("delivery failed")
+
+
+class BrokenBackend(BaseBackend):
+    """
+    Can only be built in the calling thread, not in the workers.
+    """
+    supports_concurrency = True
+
+    def __init__(self, medium, **kwargs):
+        if threading.current_thread().name != "MainThread":
+            raise ValueError("backend unavailable")
+        super(BrokenBackend, self).__init__(medium, **kwargs)
+
+
+@override_settings(NOTIFICATION_MEDIA=(("1", "Email"), ("2", "Other")),
+                   NOTIFICATION_BACKENDS={
+                       "1": "notification.tests.RecordingBackend",
+                       "2": "notification.tests.RecordingBackend",
+                   })
+class DeliveryEngineTest(TestCase):
+
+    def setUp(self):
+        RecordingBackend.reset()
+
+    def test_concurrent_delivery(self):
+        engine = DeliveryEngine({"1": 3})
+        engine.send("1", range(6))
+        engine.close()
+        self.assertEqual(sorted(RecordingBackend.delivered), list(range(6)))
+        self.assertEqual(RecordingBackend.max_running, 3)
+
+    def test_limit_per_medium(self):
+        engine = DeliveryEngine({"1": 2})
+        for i in range(4):
+            engine.send("1", range(i * 10, i * 10 + 10))
+        engine.close()
+        self.assertEqual(len(RecordingBackend.delivered), 40)
+        self.assertEqual(RecordingBackend.max_running, 2)
+
+    def test_medium_without_concurrency(self):
+        engine = DeliveryEngine({"1": 2})
+        engine.send("2", range(6))
+        engine.close()
+        self.assertEqual(RecordingBackend.max_running, 1)
+        self.assertEqual(RecordingBackend.threads,
+                         set([threading.current_thread()]))
+
+    @override_settings(NOTIFICATION_BACKENDS={
+        "1": "notification.tests.FailingBackend",
+    })
+    def test_worker_errors_raised_on_close(self):
+        engine = DeliveryEngine({"1": 2})
+        engine.send("1", range(4))
+        self.assertRaises(ValueError, engine.close)
+
+    @override_settings(NOTIFICATION_BACKENDS={
+        "1": "notification.tests.BrokenBackend",
+    })
+    def test_backend_errors_raised_on_close(self):
+        engine = DeliveryEngine({"1": 2})
+        # more batches than the queues hold, which would block without workers
+        for i in range(10):
+            engine.send("1", range(4))
+        self.assertRaises(ValueError, engine.close)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+                   EMAIL_HOST="127.0.0.1", EMAIL_USE_TLS=False,
+                   EMAIL_HOST_USER="", EMAIL_HOST_PASSWORD="",
+                   NOTIFICATION_USE_QUEUE=False, NOTIFICATION_USE_CACHE=False,
+                   NOTIFICATION_RATE_LIMITS={}, NOTIFICATION_COALESCE_WINDOW=None)
+class SMTPDeliveryTest(TestCase):
+
+    def setUp(self):
+        self.server = StubSMTPServer()
+        self.server.start()
+        NoticeType.objects.create(label="test", display="Test",
+                                  description="Test", default=2)
+        self.users = [User.objects.create_user("user_%d" % i,
+                                               "user_%d@example.com" % i,
+                                               "secret")
+                      for i in range(6)]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def recipients(self):
+        return sorted(address for peer, rcpttos in self.server.messages
+                      for address in rcpttos)
+
+    def connections(self):
+        return set(peer for peer, rcpttos in self.server.messages)
+
+    def test_notify(self):
+        with self.settings(EMAIL_PORT=self.server.port):
+            notify(self.users, "test", concurrency={"1": 3})
+        self.assertEqual(self.recipients(),
+                         sorted(user.email for user in self.users))
+        # one connection per worker
+        self.assertTrue(1 < len(self.connections()) <= 3)
+
+    def test_notify_sequential(self):
+        with self.settings(EMAIL_PORT=self.server.port):
+            notify(self.users, "test", concurrency={})
+        self.assertEqual(len(self.server.messages), 6)
+        self.assertEqual(len(self.connections()), 1)
+
+    def test_send_notice_command(self):
+        with self.settings(EMAIL_PORT=self.server.port):
+            call_command("send_notice", "test", all=True, concurrency=2,
+                         verbosity=0)
+        self.assertEqual(self.recipients(),
+                         sorted(user.email for user in self.users))
+        self.assertTrue(len(self.connections()) <= 2)
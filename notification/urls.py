@@ -3,8 +3,12 @@ from django.conf.urls.defaults import patterns, url
 
 urlpatterns = patterns("notification.views",
     url(r"^$", "notice_list", name="notification_notices"),
+    url(r"^json/$", "notice_list_json", name="notification_notices_json"),
     url(r"^settings/$", "notice_settings", name="notification_notice_settings"),
     url(r"^(\d+)/$", "notice_detail", name="notification_notice"),
     url(r"^feed/$", "notice_feed", name="notification_feed_for_user"),
     url(r"^mark_all_seen/$", "mark_all_seen", name="notification_mark_all_seen"),
+    url(r"^mark_seen/$", "mark_seen", name="notification_mark_seen"),
+    url(r"^archive/$", "archive_many", name="notification_archive_many"),
+    url(r"^delete/$", "delete_many", name="notification_delete_many"),
 )
@@ -1,13 +1,30 @@
+import time
+import uuid
+import base64
+import socket
+import hashlib
+import logging
+import threading
+from smtplib import SMTPServerDisconnected
+from collections import OrderedDict
+
 from django.db import models
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.template import Context
-from django.template.loader import render_to_string
-from django.core.urlresolvers import reverse, set_script_prefix
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import get_template
+from django.core.urlresolvers import reverse, get_script_prefix, set_script_prefix
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import get_language, activate
 
 from notification.conf import settings
 
+logger = logging.getLogger('notification')
+
 
 ### QUEUE ##############################################################
 
@@ -31,11 +48,241 @@ def can_queue(func, **kwargs):
 
 
 def maybe_delay(func, *args, **kwargs):
-    if can_queue(func, **kwargs):
+    use_queue = kwargs.pop('use_queue', settings.NOTIFICATION_USE_QUEUE)
+    if can_queue(func, use_queue=use_queue):
         return func.delay(*args, **kwargs)
     return func(*args, **kwargs)
 
 
+# marks the model references of serialized contexts
+MODEL_REFERENCE = "__model__"
+
+
+def serialize_context(context):
+    """
+    Returns a copy of ``context`` suitable for a queue message: model
+    instances are replaced by (content type id, primary key) references.
+    """
+    if not context:
+        return context
+    serialized = {}
+    for key, value in context.items():
+        if isinstance(value, models.Model):
+            content_type = ContentType.objects.get_for_model(value)
+            value = {MODEL_REFERENCE: (content_type.pk, value.pk)}
+        serialized[key] = value
+    return serialized
+
+
+def deserialize_context(context):
+    """
+    Returns a copy of ``context`` with the model references made by
+    ``serialize_context`` replaced by the instances, fetched with one query
+    per model. References to deleted objects are replaced by ``None``.
+    """
+    if not context:
+        return context
+    deserialized = dict(context)
+    references = {}
+    for key, value in context.items():
+        if isinstance(value, dict) and MODEL_REFERENCE in value:
+            content_type_id, pk = value[MODEL_REFERENCE]
+            references.setdefault(content_type_id, {})[key] = pk
+    for content_type_id, pks in references.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        instances = model._default_manager.in_bulk(pks.values())
+        for key, pk in pks.items():
+            deserialized[key] = instances.get(pk)
+    return deserialized
+
+
+def get_pks(users):
+    """
+    Returns the primary keys of ``users``, which may be User instances or
+    primary keys already.
+    """
+    return [getattr(user, "pk", user) for user in users]
+
+
+def get_users(users):
+    """
+    Returns ``users`` as User instances, fetching those given as primary keys
+    with a single query. Users which do not exist are dropped.
+    """
+    pks = [user for user in users if not isinstance(user, User)]
+    if not pks:
+        return list(users)
+    instances = User.objects.in_bulk(pks)
+    return [user if isinstance(user, User) else instances[user]
+            for user in users
+            if isinstance(user, User) or user in instances]
+
+
+### LOCKING ############################################################
+
+
+class LockTimeout(Exception):
+    pass
+
+
+# cache backends whose ``add`` isn't atomic across processes
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.dummy.DummyCache",
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.filebased.FileBasedCache",
+)
+
+
+def has_shared_cache():
+    """
+    Returns whether the default cache can hold locks shared by processes.
+    """
+    backend = settings.CACHES.get("default", {}).get("BACKEND")
+    return backend not in LOCAL_CACHE_BACKENDS
+
+
+class cache_lock(object):
+    """
+    Holds a lock named ``key`` in Django's cache, waiting at most ``timeout``
+    seconds to acquire it before raising LockTimeout. The lock expires after
+    ``expires`` seconds.
+
+    Locks are only shared between processes by shared cache backends such as
+    memcached, which implement ``add`` atomically.
+    """
+    def __init__(self, key, timeout=10, expires=60):
+        self.key = key
+        self.timeout = timeout
+        self.expires = expires
+        # tells our lock from one taken by another worker after ours expired
+        self.token = uuid.uuid4().hex
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while not cache.add(self.key, self.token, self.expires):
+            if time.time() >= deadline:
+                raise LockTimeout("Could not acquire lock %s" % self.key)
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+### BATCH ##############################################################
+
+
+def chunked(iterable, size):
+    """
+    Yields successive lists of at most ``size`` items from ``iterable``.
+
+    >>> list(chunked([1, 2, 3], 2))
+    [[1, 2], [3]]
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+### EMAIL ##############################################################
+
+
+def send_email_messages(messages, connection, retries=1):
+    """
+    Sends ``messages`` over the already opened email ``connection`` and
+    returns the number of messages sent.
+
+    Messages are handed to the backend one at a time so that, if the
+    connection drops, it is reopened and only the failed message is sent
+    again, up to ``retries`` times.
+    """
+    sent = 0
+    for message in messages:
+        attempt = 0
+        while True:
+            try:
+                sent += connection.send_messages([message]) or 0
+                break
+            except (SMTPServerDisconnected, socket.error):
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.warning("Email connection lost, reconnecting")
+                connection.close()
+                connection.open()
+    return sent
+
+
+### PAGINATION #########################################################
+
+
+def encode_cursor(notice):
+    """
+    Returns an opaque cursor pointing after ``notice`` in a list ordered by
+    descending (added, id), see ``NoticeManager.page_after``.
+    """
+    return base64.urlsafe_b64encode(
+        ("%s|%d" % (notice.added.isoformat(), notice.pk)).encode("ascii")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (added, id) pair of a cursor made by ``encode_cursor``.
+    Raises ValueError for invalid cursors.
+    """
+    try:
+        added, pk = base64.urlsafe_b64decode(str(cursor)).decode("ascii").split("|")
+        added = parse_datetime(added)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor %r" % cursor)
+    if added is None:
+        raise ValueError("Invalid cursor %r" % cursor)
+    return added, pk
+
+
+### SEEN BUFFER ########################################################
+
+
+_seen_buffer = threading.local()
+
+
+def start_seen_buffer():
+    """
+    Starts buffering, for the current thread, the notices marked seen by
+    ``Notice.is_unseen``.
+    """
+    _seen_buffer.notices = {}
+
+
+def buffer_seen(notice):
+    """
+    Adds ``notice`` to the buffer of the current thread. Returns False if
+    there is no buffer.
+    """
+    notices = getattr(_seen_buffer, "notices", None)
+    if notices is None:
+        return False
+    notices[notice.pk] = notice.recipient_id
+    return True
+
+
+def stop_seen_buffer():
+    """
+    Stops buffering and returns the buffered notices as a dictionary mapping
+    their ids to the ids of their recipients.
+    """
+    notices = getattr(_seen_buffer, "notices", None) or {}
+    _seen_buffer.notices = None
+    return notices
+
+
 ### LANGUAGE ###########################################################
 
 
@@ -87,27 +334,147 @@ def get_notification_language(user):
 ### TEMPLATE ###########################################################
 
 
+# site id -> site-derived context variables
+_site_context_cache = {}
+
+
+def get_site_context(site=None):
+    """
+    Returns the site-derived variables of notification contexts for ``site``
+    (the current site by default). They are computed once per site.
+    """
+    if site is None:
+        site = Site.objects.get_current()
+    try:
+        return _site_context_cache[site.pk]
+    except KeyError:
+        pass
+
+    protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
+    site_url = u"%s://%s" % (protocol, unicode(site.domain))
+
+    media_url = settings.MEDIA_URL
+    if not media_url.startswith('http'):
+        media_url = u'%s%s' % (site_url, media_url)
+
+    # reverse absolute URLs, restoring the prefix of the current thread
+    script_prefix = get_script_prefix()
+    set_script_prefix(site_url)
+    try:
+        notices_url = reverse('notification_notices')
+        notices_settings_url = reverse('notification_notice_settings')
+    finally:
+        set_script_prefix(script_prefix)
+
+    site_context = {
+        'current_site': site,  # backward-compatibility
+        'site': site,
+        'site_url': site_url,
+        'notices_url': notices_url,
+        'notices_settings_url': notices_settings_url,
+        'STATIC_URL': settings.STATIC_URL,
+        'MEDIA_URL': media_url,
+    }
+    _site_context_cache[site.pk] = site_context
+    return site_context
+
+
+def clear_site_context_cache(sender, **kwargs):
+    _site_context_cache.clear()
+post_save.connect(clear_site_context_cache, sender=Site)
+post_delete.connect(clear_site_context_cache, sender=Site)
+
+
 class NotificationContext(Context):
     def __init__(self, dict_=None, **kwargs):
         super(NotificationContext, self).__init__(dict_, **kwargs)
 
-        protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
-        current_site = Site.objects.get_current()
-        site_url = u"%s://%s" % (protocol, unicode(current_site.domain))
+        site_context = get_site_context()
+
+        # lets {% url %} build absolute URLs; the prefix is thread-local
+        set_script_prefix(site_context['site_url'])
+
+        # push a copy so that writes to the context never reach the cache
+        self.update(dict(site_context))
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping holding at most ``maxsize`` items, discarding the
+    least recently used ones first.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+# (label, format) -> compiled template
+_template_cache = LRUCache(settings.NOTIFICATION_TEMPLATE_CACHE_SIZE)
+
+
+def get_notification_template(label, format):
+    """
+    Returns the compiled template rendering ``format`` for the notice type
+    ``label``: ``notification/<label>/<format>`` if it exists,
+    ``notification/<format>`` otherwise.
+
+    The choice and the compiled template are memoized per (label, format),
+    except when DEBUG is on so that edited and added templates are used
+    right away.
+    """
+    key = (label, format)
+    template = None
+    if not settings.DEBUG:
+        template = _template_cache.get(key)
+    if template is None:
+        try:
+            template = get_template("notification/%s/%s" % (label, format))
+        except TemplateDoesNotExist:
+            template = get_template("notification/%s" % format)
+        if not settings.DEBUG:
+            _template_cache[key] = template
+    return template
 
-        if not settings.MEDIA_URL.startswith('http'):
-            settings.MEDIA_URL = u'%s%s' % (site_url, settings.MEDIA_URL)
 
-        set_script_prefix(site_url)
+# sha1 of the html -> inlined html
+_inlined_css_cache = LRUCache(settings.NOTIFICATION_PYNLINER_CACHE_SIZE)
 
-        self.update({
-            'current_site': current_site,  # backward-compatibility
-            'site': current_site,
-            'site_url': site_url,
-            'notices_url': reverse('notification_notices'),
-            'notices_settings_url': reverse('notification_notice_settings'),
-            'STATIC_URL': settings.STATIC_URL,
-        })
+
+def inline_css(html):
+    """
+    Returns ``html`` with its CSS inlined into the style attributes of its
+    elements by pynliner. Results are cached by content hash, so identical
+    documents, e.g. a notice without recipient-specific content, are only
+    processed once.
+    """
+    key = hashlib.sha1(html.encode("utf-8")).hexdigest()
+    inlined = _inlined_css_cache.get(key)
+    if inlined is None:
+        import pynliner
+        inlined = pynliner.fromString(html)
+        _inlined_css_cache[key] = inlined
+    return inlined
 
 
 def get_formatted_messages(formats, label, context):
@@ -122,8 +489,6 @@ def get_formatted_messages(formats, label, context):
             context.autoescape = False
         else:
             context.autoescape = True
-        format_templates[format] = render_to_string((
-                "notification/%s/%s" % (label, format),
-                "notification/%s" % format),
-            context_instance=context)
+        template = get_notification_template(label, format)
+        format_templates[format] = template.render(context)
     return format_templates
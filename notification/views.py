@@ -1,8 +1,12 @@
+import json
+
 from django.core.urlresolvers import reverse
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.template import RequestContext
 
+from django.views.decorators.http import require_POST
+
 from django.contrib.auth.decorators import login_required
 from django.contrib.syndication.views import Feed
 
@@ -18,6 +22,8 @@ def notice_feed(request):
     An atom feed for all unarchived :model:`notification.Notice`s for a user.
     """
     url = "feed/%s" % request.user.username
+    if request.GET.get("after"):
+        url = "%s/%s" % (url, request.GET["after"])
     return Feed(request, url, {
         "feed": NoticeUserFeed,
     })
@@ -26,23 +32,65 @@ def notice_feed(request):
 @login_required
 def notice_list(request):
     """
-    The main notices index view.
+    The main notices index view, paginated by the ``after`` GET parameter.
 
     Template: :template:`notification/notices.html`
 
     Context:
 
         notices
-            A list of :model:`notification.Notice` objects that are not archived
-            and to be displayed on the site.
+            A list of at most ``NOTIFICATION_PAGE_SIZE``
+            :model:`notification.Notice` objects that are not archived and to
+            be displayed on the site.
+
+        next_cursor
+            The value of the ``after`` parameter of the next page, ``None`` on
+            the last page.
     """
-    notices = Notice.objects.notices_for(request.user, on_site=True)
+    notices, next_cursor = get_page(request)
 
     return render_to_response("notification/notices.html", {
         "notices": notices,
+        "next_cursor": next_cursor,
     }, context_instance=RequestContext(request))
 
 
+@login_required
+def notice_list_json(request):
+    """
+    The notices of :view:`notification.views.notice_list` as JSON: an object
+    with a ``notices`` list and the ``next`` cursor.
+    """
+    notices, next_cursor = get_page(request)
+    data = {
+        "notices": [{
+            "id": notice.pk,
+            "message": notice.message,
+            "notice_type": notice.notice_type.label,
+            "sender": notice.sender_id,
+            "added": notice.added.isoformat(),
+            "unseen": notice.unseen,
+            "url": notice.get_absolute_url(),
+        } for notice in notices],
+        "next": next_cursor,
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def get_page(request):
+    """
+    Returns the page of on-site notices of the requesting user following the
+    ``after`` GET parameter and the cursor of the next page.
+    """
+    try:
+        return Notice.objects.page_after(request.user,
+            cursor=request.GET.get("after"),
+            limit=settings.NOTIFICATION_PAGE_SIZE,
+            on_site=True)
+    except ValueError:
+        raise Http404
+
+
 @login_required
 def notice_settings(request):
     """
@@ -64,25 +112,22 @@ def notice_settings(request):
             variable called ``form_label``, whose valid value is ``on``.
     """
     notice_types = NoticeType.objects.all()
+    send_map = NoticeSetting.objects.get_map(request.user, notice_types)
+    posted = {}
     settings_table = []
     for notice_type in notice_types:
         settings_row = []
         for medium_id, medium_display in settings.NOTIFICATION_MEDIA:
             form_label = "%s_%s" % (notice_type.label, medium_id)
-            setting = NoticeSetting.objects.get_for(request.user, notice_type, medium_id)
+            send = send_map[(notice_type.pk, medium_id)]
             if request.method == "POST":
-                if request.POST.get(form_label) == "on":
-                    if not setting.send:
-                        setting.send = True
-                        setting.save()
-                else:
-                    if setting.send:
-                        setting.send = False
-                        setting.save()
-            settings_row.append((form_label, setting.send))
+                send = request.POST.get(form_label) == "on"
+                posted[(notice_type, medium_id)] = send
+            settings_row.append((form_label, send))
         settings_table.append({"notice_type": notice_type, "cells": settings_row})
 
     if request.method == "POST":
+        NoticeSetting.objects.set_many(request.user, posted)
         next_page = request.POST.get("next_page", ".")
         return HttpResponseRedirect(next_page)
 
@@ -117,9 +162,8 @@ def notice_detail(request, id, mark_seen=True):
     """
     notice = get_object_or_404(Notice, id=id)
     if request.user == notice.recipient:
-        if mark_seen and notice.unseen:
-            notice.unseen = False
-            notice.save()
+        if mark_seen:
+            notice.mark_seen()
         return render_to_response("notification/single.html", {
             "notice": notice,
         }, context_instance=RequestContext(request))
@@ -189,7 +233,52 @@ def mark_all_seen(request):
     ``HttpResponseRedirect`` when complete.
     """
 
-    for notice in Notice.objects.notices_for(request.user, unseen=True):
-        notice.unseen = False
-        notice.save()
+    Notice.objects.mark_seen(request.user)
     return HttpResponseRedirect(reverse("notification_notices"))
+
+
+def get_posted_ids(request):
+    """
+    Returns the notice ids posted as ``id`` values, ignoring invalid ones.
+    """
+    return [int(id) for id in request.POST.getlist("id") if id.isdigit()]
+
+
+@require_POST
+@login_required
+def mark_seen(request):
+    """
+    Mark the requesting user's notices whose ids are posted as ``id`` values
+    seen.  Redirects to the posted ``next_page`` or the notices index.
+    """
+    Notice.objects.mark_seen(request.user, get_posted_ids(request))
+    next_page = request.POST.get("next_page", reverse("notification_notices"))
+    return HttpResponseRedirect(next_page)
+
+
+@require_POST
+@login_required
+def archive_many(request):
+    """
+    Archive the :model:`notices.Notice` objects whose ids are posted as
+    ``id`` values, if the requesting user is their recipient or is a
+    superuser.  Redirects to the posted ``next_page`` or the notices index.
+    """
+    user = None if request.user.is_superuser else request.user
+    Notice.objects.archive_many(user, get_posted_ids(request))
+    next_page = request.POST.get("next_page", reverse("notification_notices"))
+    return HttpResponseRedirect(next_page)
+
+
+@require_POST
+@login_required
+def delete_many(request):
+    """
+    Delete the :model:`notices.Notice` objects whose ids are posted as ``id``
+    values, if the requesting user is their recipient or is a superuser.
+    Redirects to the posted ``next_page`` or the notices index.
+    """
+    user = None if request.user.is_superuser else request.user
+    Notice.objects.delete_many(user, get_posted_ids(request))
+    next_page = request.POST.get("next_page", reverse("notification_notices"))
+    return HttpResponseRedirect(next_page)
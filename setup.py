@@ -11,6 +11,7 @@ setup(
     url="https://github.com/jtauber/django-notification",
     packages=find_packages(),
     install_requires=[
+        'Django>=1.4',
         'celery>=2.5.3',
         'django-appconf >= 0.4',
     ],
@@ -21,6 +22,7 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 2.7",
         "Framework :: Django",
     ],
     include_package_data=True,